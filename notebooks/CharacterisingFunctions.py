@@ -4,12 +4,124 @@ import matplotlib.pyplot as plt
 import numpy as np
 import operator
 import math
-
-
+import weakref
+import hashlib,json,os
+import heapq
+from xml.sax.saxutils import escape, quoteattr
+from collections import Counter
+
+
+
+
+# A frequency distribution keeps its terms in a vocabulary (term -> index) and their counts in an array, so
+# lookups are O(1), probabilities are one division and the k most frequent terms are found by partial selection.
+# size is the total count of the corpus it describes, which top() keeps so that probabilities stay relative to the
+# whole corpus.  It unpacks as the (size, [(term, count), ...] most frequent first) pairs which it replaces
+
+class FreqDist:
+
+    def __init__(self, terms=(), counts=(), size=None):
+        self.terms = list(terms)
+        self.index = {term: i for (i, term) in enumerate(self.terms)}
+        self.counts = np.asarray(counts) if len(self.terms) > 0 else np.zeros(0, dtype=np.int64)
+        self.size = self.counts.sum().item() if size is None else size
+        self.ordered = False
+        self.pairs = None
+
+    @classmethod
+    def from_counts(cls, counts, size=None):
+        # from a dict of term counts
+        return cls(counts.keys(), list(counts.values()), size)
+
+    @classmethod
+    def from_items(cls, items, size=None):
+        # from (term, count) pairs, adding up repeated terms
+        counts = {}
+        for (term, count) in items:
+            counts[term] = counts.get(term, 0) + count
+        return cls.from_counts(counts, size)
+
+    @classmethod
+    def from_values(cls, values):
+        # the number of times each value occurs
+        return cls.from_counts(Counter(values))
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        return term in self.index
+
+    def get(self, term, default=0):
+        i = self.index.get(term)
+        if i is None:
+            return default
+        return self.counts[i].item()
+
+    def counts_of(self, terms, default=0):
+        # array of the counts of terms; default (which may be an array with one value per term) for those not present
+        positions = np.fromiter((self.index.get(term, -1) for term in terms), dtype=np.int64, count=len(terms))
+        found = positions >= 0
+        counts = np.where(found, 0, default).astype(np.result_type(self.counts, default))
+        counts[found] = self.counts[positions[found]]
+        return counts
+
+    def align(self, other, default=0):
+        # the counts of this distribution's terms here and in other
+        return self.counts, other.counts_of(self.terms, default)
+
+    def probabilities(self):
+        if self.size == 0:
+            return np.zeros(len(self.counts))
+        return self.counts / self.size
+
+    def order(self, k=None):
+        # indexes of the k (or all) most frequent terms, most frequent first.  Terms with the same count keep their order
+        n = len(self.counts)
+        if k is None or k >= n:
+            selected = np.arange(n)
+        elif k <= 0:
+            selected = np.zeros(0, dtype=np.int64)
+        else:
+            kth = np.partition(self.counts, n - k)[n - k]
+            above = np.flatnonzero(self.counts > kth)
+            tied = np.flatnonzero(self.counts == kth)[:k - len(above)]
+            selected = np.concatenate([above, tied])
+        return selected[np.lexsort((selected, -self.counts[selected]))]
+
+    def top(self, k=None):
+        # the distribution of the k most frequent terms, in order, with the same size
+        if self.ordered and (k is None or k >= len(self.terms)):
+            return self
+        selected = self.order(k)
+        dist = FreqDist([self.terms[i] for i in selected], self.counts[selected], self.size)
+        dist.ordered = True
+        return dist
+
+    def items(self, k=None):
+        # (term, count) pairs, most frequent first
+        if self.pairs is None:
+            dist = self.top()
+            self.pairs = list(zip(dist.terms, dist.counts.tolist()))
+        return self.pairs[:k]
+
+    def __iter__(self):
+        return iter((self.size, self.items()))
+
+    def __getitem__(self, i):
+        return (self.size, self.items())[i]
+
+
+def as_freqdist(dist):
+    # a FreqDist from a FreqDist or a (size, [(term, count), ...]) pair
+    if isinstance(dist, FreqDist):
+        return dist
+    (size, items) = dist
+    return FreqDist.from_items(items, size)
 
 
 # For a given set of corpora, find the frequency distribution of the k highest frequency words
-# Output total size of corpus and sorted list of term, frequency pairs
+# Output total size of corpus and sorted list of term, frequency pairs (as a FreqDist)
 
 def find_hfw_dist(corpora, k=100000,ftype='termfreq'):
     # add worddicts for individual corpora
@@ -17,28 +129,30 @@ def find_hfw_dist(corpora, k=100000,ftype='termfreq'):
     # visualise
     #default is 'termfreq' but can also be used for 'docfreq'
 
-    sumdict = {}
+    #corpora may be corpora or their (merged) statistics, e.g. [male_corpus.stats()+female_corpus.stats()]
+    sumdict = Counter()
     corpussize = 0
     for acorpus in corpora:
         if ftype=='docfreq':
-            fdict=acorpus.docfreq
+            fdict = Counter()
+            for (key, value) in acorpus.docfreq.items():
+                fdict[key.lower()] += value
         else:
+            #allworddict keys are already lower case
             fdict=acorpus.allworddict
-        for (key, value) in fdict.items():
-            sumdict[key.lower()] = sumdict.get(key.lower(), 0) + value
-            corpussize += value
+        sumdict.update(fdict)
+        corpussize += sum(fdict.values())
 
     print("Size of corpus is {}".format(corpussize))
-    candidates = sorted(sumdict.items(), key=operator.itemgetter(1), reverse=True)
-    # print(candidates[:50])
-    # print(len(sumdict))
-    # print(sumdict)
-    return corpussize, candidates[:k]
+    return FreqDist.from_counts(sumdict, corpussize).top(k)
 
 
     
 
 def makedict(alist):
+    #a dict of term -> count from (term, count) pairs or from a FreqDist (use FreqDist.get for lookups without a dict)
+    if isinstance(alist, FreqDist):
+        return dict(zip(alist.terms, alist.counts.tolist()))
     adict = {}
     for (key, value) in alist:
         adict[key] = adict.get(key, 0) + value
@@ -124,31 +238,139 @@ def mysurprise(wf, rwf, cs, rcs, measure, params):
         print("Unknown measure of surprise")
 
 
-def improved_compute_surprises(corpusA, corpusB, measure, params={},k=50,display=True):
-    (corpusAsize, wordlistA) = corpusA
-    (corpusBsize, wordlistB) = corpusB
-    if 'threshold' in params.keys():
-        threshold = params['threshold']
+# The same measures computed for a whole vocabulary at once.  The frequencies of corpus A and of the reference are
+# aligned into arrays once and each measure is a single numpy expression over them.  Where the scalar functions
+# divide by zero or take the log of zero the terms are given explicit scores instead: pmi (and so llr) is 0 when any
+# of the counts or sizes is 0, and p*log(2p/(p+q)) is 0 when p is 0 (a term absent from one side adds nothing to kl or jsd)
+
+LLR_CUTOFF = 10.828  # chi-squared with 1 degree of freedom at p<0.001
+
+
+def align_frequencies(distA, distB, threshold=None):
+    # terms of distA (the threshold most frequent of them, most frequent first) with their frequencies in A and in the
+    # reference B.  A term missing from the reference gets its frequency in A plus one, as in improved_compute_surprises
+    distA = as_freqdist(distA).top(threshold)
+    freqs, reffreqs = distA.align(as_freqdist(distB), default=distA.counts + 1)
+    return distA.terms, freqs.astype(float), reffreqs.astype(float)
+
+
+def log_ratio(num, den):
+    # log(num/den) where both are positive, otherwise 0
+    num, den = np.broadcast_arrays(np.asarray(num, dtype=float), np.asarray(den, dtype=float))
+    score = np.zeros(num.shape)
+    ok = (num > 0) & (den > 0)
+    score[ok] = np.log(num[ok] / den[ok])
+    return score
+
+
+def pmi_array(wordfreq, refwordfreq, corpussize, refcorpussize):
+    return log_ratio(wordfreq * refcorpussize, refwordfreq * corpussize)
+
+
+def llr_array(wordfreq, refwordfreq, corpussize, refcorpussize):
+    mypmi = pmi_array(wordfreq, refwordfreq, corpussize, refcorpussize)
+    myrevpmi = pmi_array(refwordfreq - wordfreq, refwordfreq, refcorpussize - corpussize, refcorpussize)
+    llr_score = 2 * (wordfreq * mypmi + (refwordfreq - wordfreq) * myrevpmi)
+    return np.where(mypmi < 0, -llr_score, llr_score)
+
+
+def proportions(wordfreq, refwordfreq, corpussize, refcorpussize):
+    # p of each term in A and q in the rest of the reference; 0 where a corpus is empty
+    p = wordfreq / corpussize if corpussize > 0 else np.zeros(np.shape(wordfreq))
+    rest = refcorpussize - corpussize
+    q = (refwordfreq - wordfreq) / rest if rest != 0 else np.zeros(np.shape(wordfreq))
+    return p, q
+
+
+def klp_array(p, q):
+    return p * log_ratio(2 * p, p + q)
+
+
+def kl_array(wordfreq, refwordfreq, corpussize, refcorpussize):
+    p, q = proportions(wordfreq, refwordfreq, corpussize, refcorpussize)
+    return klp_array(p, q)
+
+
+def jsd_array(wordfreq, refwordfreq, corpussize, refcorpussize):
+    p, q = proportions(wordfreq, refwordfreq, corpussize, refcorpussize)
+    score = 0.5 * (klp_array(p, q) + klp_array(q, p))
+    return np.where(p > q, score, -score)
+
+
+def likelihoodlift_array(wordfreq, refwordfreq, corpussize, refcorpussize, alpha):
+    if alpha == 0:
+        return pmi_array(wordfreq, refwordfreq, corpussize, refcorpussize)
+    with np.errstate(divide='ignore'):
+        # a term which does not occur in A has a likelihood of 0, so a log likelihood of -inf
+        loglikelihood = np.log(wordfreq / corpussize)
+    if alpha == 1:
+        return loglikelihood
+    return alpha * loglikelihood + (1 - alpha) * pmi_array(wordfreq, refwordfreq, corpussize, refcorpussize)
+
+
+def surprise_array(wf, rwf, cs, rcs, measure, params={}):
+    # mysurprise for arrays of frequencies
+    if measure == 'pmi':
+        return pmi_array(wf, rwf, cs, rcs)
+    elif measure == 'llr':
+        return llr_array(wf, rwf, cs, rcs)
+    elif measure == 'kl':
+        return kl_array(wf, rwf, cs, rcs)
+    elif measure == 'jsd':
+        return jsd_array(wf, rwf, cs, rcs)
+    elif measure == 'likelihoodlift':
+        return likelihoodlift_array(wf, rwf, cs, rcs, params.get('alpha', 0.5))
     else:
-        threshold = len(wordlistA)
-    # dictA=makedict(wordlistA)
-    dictB = makedict(wordlistB)
+        raise ValueError("Unknown measure of surprise: {}".format(measure))
+
+
+class Keyness:
+    # the scores of every term of corpus A against the reference.  order lists the term indexes best first (ties keep
+    # the order of the word list) and ranks[i] is the rank of term i, from 0.  For llr, significant is the number of
+    # terms scoring over cutoff
+
+    def __init__(self, terms, scores, measure, cutoff=LLR_CUTOFF):
+        self.terms = terms
+        self.ids = {term: i for (i, term) in enumerate(terms)}
+        self.scores = scores
+        self.measure = measure
+        self.cutoff = cutoff
+        self.order = np.argsort(-scores, kind='stable')
+        self.ranks = np.empty(len(scores), dtype=np.int64)
+        self.ranks[self.order] = np.arange(len(scores))
+        if measure == 'llr':
+            self.significant = int(np.count_nonzero(scores > cutoff))
+        else:
+            self.significant = None
 
-    scores = []
-    # print(wordlistA[:threshold])
-    for (term, freq) in wordlistA[:threshold]:
-        scores.append((term, mysurprise(freq, dictB.get(term, freq + 1), corpusAsize, corpusBsize, measure, params)))
-    sortedscores = sorted(scores, key=operator.itemgetter(1), reverse=True)
+    def __len__(self):
+        return len(self.terms)
+
+    def top(self, k=None):
+        # (term, score) pairs best first
+        return [(self.terms[i], float(self.scores[i])) for i in self.order[:k]]
+
+    def score(self, term):
+        return float(self.scores[self.ids[term]])
+
+
+def keyness(corpusA, corpusB, measure, params={}):
+    # corpusA and corpusB are FreqDists (or (size, word list) pairs) as returned by find_hfw_dist
+    corpusA = as_freqdist(corpusA)
+    corpusB = as_freqdist(corpusB)
+    terms, freqs, reffreqs = align_frequencies(corpusA, corpusB, params.get('threshold'))
+    scores = surprise_array(freqs, reffreqs, corpusA.size, corpusB.size, measure, params)
+    return Keyness(terms, scores, measure)
+
+
+def improved_compute_surprises(corpusA, corpusB, measure, params={},k=50,display=True):
+    result = keyness(corpusA, corpusB, measure, params)
+    sortedscores = result.top()
     if display and k>0:
         print("Top {} terms are ".format(k))
         print(sortedscores[:k])
-    rank = 0
     if measure == "llr":
-        for (term, score) in sortedscores:
-            if score > 10.828:
-                rank += 1
-            else:
-                break
+        rank = result.significant
         print("{} significantly characterising terms".format(rank))
     else:
         rank = k
@@ -320,38 +542,376 @@ def analyse(termset, corpus):
     improved_display_list(xvalues, yvalues, labels)
 
 
-def nearest_neighbours(wordset, w2vmodel):
+# An approximate nearest neighbour index over the vocabulary of a word2vec model: a forest of random projection trees.
+# Each tree splits the (normalised) word vectors in two at the hyperplane halfway between two randomly chosen words, and
+# again within each side, until there are at most leaf_size words in each leaf.  The neighbours of a word are found
+# among the words sharing a leaf with it in any of the trees searched, ranked by their exact cosine similarity.  More
+# trees (up to the number built) find more of the true neighbours and take longer.  For higher recall, search_k visits
+# leaves in all the trees, closest to the query first, until it has that many candidates (as in Annoy), and
+# exact=True ranks the whole vocabulary.  The index is kept per model and rebuilt when the model's vectors change;
+# clear_neighbour_index drops the kept indexes
+
+def vocabulary_of(model):
+    # the words and vectors of a word2vec model (gensim 4 or 3)
+    wv = model.wv
+    terms = getattr(wv, 'index_to_key', None)
+    if terms is None:
+        terms = wv.index2word
+    return list(terms), wv.vectors
+
+
+def vectors_digest(vectors):
+    return hashlib.sha1(np.ascontiguousarray(vectors, dtype=np.float32).tobytes()).hexdigest()
+
+
+def normalised(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+# exact search ranks the vocabulary for a block of queries at a time, with at most this many bytes of similarities
+EXACT_BLOCK_BYTES = 32 * 2 ** 20
+
+
+def best_neighbours(candidates, sims, k, excluded):
+    # the k candidates with the highest similarities (except excluded, a word id or -1), as (ids, similarities)
+    if excluded >= 0:
+        keep = candidates != excluded
+        candidates = candidates[keep]
+        sims = sims[keep]
+    if k < len(sims):
+        top = np.argpartition(-sims, k - 1)[:k]
+    else:
+        top = np.arange(len(sims))
+    top = top[np.argsort(-sims[top], kind='stable')]
+    return candidates[top], sims[top]
+
+
+def exact_search(queries, vectors, k, exclude):
+    # (ids, similarities) of the k nearest of the normalised vectors to each normalised query
+    block = max(1, EXACT_BLOCK_BYTES // (4 * max(len(vectors), 1)))
+    ids = np.arange(len(vectors))
+    results = []
+    for start in range(0, len(queries), block):
+        sims = queries[start:start + block].dot(vectors.T)
+        for (row, excluded) in zip(sims, exclude[start:start + block]):
+            results.append(best_neighbours(ids, row, k, excluded))
+    return results
+
+
+def exact_neighbours(terms, model, k=10):
+    # for each term, its k nearest other words as NeighbourIndex.query gives them with exact=True, ranked straight
+    # from the model's vectors without building an index
+    (vocabulary, vectors) = vocabulary_of(model)
+    vectors = normalised(vectors)
+    positions = {term: i for (i, term) in enumerate(vocabulary)}
+    ids = np.array([positions.get(term, -1) for term in terms], dtype=np.int64)
+    known = np.flatnonzero(ids >= 0)
+    results = [None] * len(terms)
+    for (i, (neighbours, sims)) in zip(known, exact_search(vectors[ids[known]], vectors, k, ids[known])):
+        results[i] = [(vocabulary[j], float(sim)) for (j, sim) in zip(neighbours, sims)]
+    return results
+
+
+class NeighbourIndex:
+
+    def __init__(self, terms, vectors, n_trees=10, leaf_size=64, seed=None, digest=None):
+        # digest is given (with the trees) when loading a saved index, which is not built again
+        self.terms = list(terms)
+        self.ids = {term: i for (i, term) in enumerate(self.terms)}
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        if digest is None:
+            self.digest = vectors_digest(vectors)
+            self.vectors = normalised(vectors)
+            self.build(np.random.RandomState(seed))
+        else:
+            # saved already normalised
+            self.digest = digest
+            self.vectors = vectors
+
+    def build(self, rng):
+        # the nodes of all the trees are kept in arrays.  An internal node sends a vector v to children[node, 1] if
+        # v.normals[node] > offsets[node] and to children[node, 0] otherwise; a leaf (children -1) holds the words
+        # leaves[starts[node]:ends[node]]
+        dim = self.vectors.shape[1]
+        normals = []
+        offsets = []
+        children = []
+        starts = []
+        ends = []
+        leaves = []
+        leafcount = 0
+
+        def new_node():
+            normals.append(np.zeros(dim, dtype=np.float32))
+            offsets.append(0.0)
+            children.append([-1, -1])
+            starts.append(0)
+            ends.append(0)
+            return len(offsets) - 1
+
+        self.roots = []
+        for t in range(self.n_trees):
+            stack = [(np.arange(len(self.terms)), new_node())]
+            self.roots.append(stack[0][1])
+            while stack:
+                (ids, node) = stack.pop()
+                if len(ids) <= self.leaf_size:
+                    starts[node] = leafcount
+                    leaves.append(ids)
+                    leafcount += len(ids)
+                    ends[node] = leafcount
+                    continue
+                (a, b) = rng.choice(ids, 2, replace=False)
+                normal = self.vectors[a] - self.vectors[b]
+                offset = normal.dot(self.vectors[a] + self.vectors[b]) / 2
+                side = self.vectors[ids].dot(normal) > offset
+                if side.all() or not side.any():
+                    # the two words have the same vector: split at a random hyperplane through their mean instead
+                    normal = rng.randn(dim).astype(np.float32)
+                    offset = normal.dot(self.vectors[ids].mean(axis=0))
+                    side = self.vectors[ids].dot(normal) > offset
+                    if side.all() or not side.any():
+                        # all the words have the same vector
+                        side = np.arange(len(ids)) < len(ids) // 2
+                length = np.linalg.norm(normal)
+                normals[node] = normal / length
+                offsets[node] = offset / length
+                children[node] = [new_node(), new_node()]
+                stack.append((ids[~side], children[node][0]))
+                stack.append((ids[side], children[node][1]))
+        self.normals = np.array(normals, dtype=np.float32).reshape(-1, dim)
+        self.offsets = np.array(offsets, dtype=np.float32)
+        self.children = np.array(children, dtype=np.int64).reshape(-1, 2)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.leaves = np.concatenate(leaves) if leaves else np.zeros(0, dtype=np.int64)
+        self.roots = np.array(self.roots, dtype=np.int64)
+
+    @classmethod
+    def from_model(cls, model, path=None, **options):
+        # the index of a word2vec model, loaded from path if it was saved there for the same vectors and options,
+        # otherwise built (and saved to path)
+        (terms, vectors) = vocabulary_of(model)
+        if path is not None and os.path.exists(path):
+            index = cls.load(path)
+            if (index.terms == terms and index.digest == vectors_digest(vectors)
+                    and all(getattr(index, name) == value for (name, value) in options.items() if name != 'seed')):
+                return index
+            print("Rebuilding neighbour index {}".format(path))
+        index = cls(terms, vectors, **options)
+        if path is not None:
+            index.save(path)
+        return index
+
+    def save(self, path):
+        meta = {'format': 1, 'terms': self.terms, 'digest': self.digest, 'n_trees': self.n_trees,
+                'leaf_size': self.leaf_size}
+        tmppath = path + ".tmp"
+        with open(tmppath, 'wb') as outstream:
+            np.savez(outstream, meta=np.array(json.dumps(meta)), vectors=self.vectors, normals=self.normals,
+                     offsets=self.offsets, children=self.children, starts=self.starts, ends=self.ends,
+                     leaves=self.leaves, roots=self.roots)
+        os.replace(tmppath, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            meta = json.loads(str(arrays['meta']))
+            index = cls(meta['terms'], arrays['vectors'], n_trees=meta['n_trees'], leaf_size=meta['leaf_size'],
+                        digest=meta['digest'])
+            for name in ('normals', 'offsets', 'children', 'starts', 'ends', 'leaves', 'roots'):
+                setattr(index, name, arrays[name])
+        return index
+
+    def __contains__(self, term):
+        return term in self.ids
+
+    def leaves_of(self, queries, trees):
+        # the leaf reached by each query vector in each of the first trees trees, as an array (queries, trees)
+        found = np.empty((len(queries), trees), dtype=np.int64)
+        for t in range(trees):
+            nodes = np.full(len(queries), self.roots[t])
+            internal = self.children[nodes, 0] >= 0
+            while internal.any():
+                at = nodes[internal]
+                right = np.einsum('ij,ij->i', queries[internal], self.normals[at]) > self.offsets[at]
+                nodes[internal] = self.children[at, right.astype(np.int64)]
+                internal = self.children[nodes, 0] >= 0
+            found[:, t] = nodes
+        return found
+
+    def probe(self, query, trees, search_k):
+        # the ids of at least search_k words (if there are that many) in the leaves of the first trees trees which
+        # are closest to query: nodes are visited in order of the smallest distance from query to any split on the
+        # way to them, on the wrong side of a split counting as negative
+        heap = [(-math.inf, root) for root in self.roots[:trees]]
+        found = []
+        count = 0
+        while heap and count < search_k:
+            (negpriority, node) = heapq.heappop(heap)
+            (left, right) = self.children[node]
+            if left < 0:
+                found.append(self.leaves[self.starts[node]:self.ends[node]])
+                count += self.ends[node] - self.starts[node]
+            else:
+                margin = float(query.dot(self.normals[node]) - self.offsets[node])
+                heapq.heappush(heap, (max(negpriority, -margin), right))
+                heapq.heappush(heap, (max(negpriority, margin), left))
+        return np.unique(np.concatenate(found))
+
+    def search(self, queries, k=10, trees=None, search_k=None, exact=False, exclude=None):
+        # (ids, similarities) of the k nearest words to each query vector, nearest first, searching the first trees
+        # trees (all of them by default), probing for search_k candidates or ranking the whole vocabulary if exact.
+        # exclude[i] is a word id (or -1) which is not a neighbour of query i
+        queries = normalised(queries)
+        if exclude is None:
+            exclude = np.full(len(queries), -1)
+        if exact:
+            return exact_search(queries, self.vectors, k, exclude)
+        results = []
+        trees = self.n_trees if trees is None else min(trees, self.n_trees)
+        if search_k is not None:
+            for (query, excluded) in zip(queries, exclude):
+                candidates = self.probe(query, trees, search_k)
+                results.append(best_neighbours(candidates, self.vectors[candidates].dot(query), k, excluded))
+            return results
+        leaves = self.leaves_of(queries, trees)
+        for (query, queryleaves, excluded) in zip(queries, leaves, exclude):
+            candidates = np.unique(np.concatenate([self.leaves[self.starts[leaf]:self.ends[leaf]] for leaf in queryleaves]))
+            results.append(best_neighbours(candidates, self.vectors[candidates].dot(query), k, excluded))
+        return results
+
+    def query(self, terms, k=10, trees=None, search_k=None, exact=False):
+        # for each term, its k nearest other words as (word, similarity) pairs like wv.most_similar, or None if
+        # the term is not in the vocabulary
+        ids = np.array([self.ids.get(term, -1) for term in terms], dtype=np.int64)
+        known = np.flatnonzero(ids >= 0)
+        results = [None] * len(terms)
+        found = self.search(self.vectors[ids[known]], k=k, trees=trees, search_k=search_k, exact=exact, exclude=ids[known])
+        for (i, (neighbours, sims)) in zip(known, found):
+            results[i] = [(self.terms[j], float(sim)) for (j, sim) in zip(neighbours, sims)]
+        return results
+
+    def recall(self, terms, k=10, trees=None, search_k=None):
+        # the proportion of the exact k nearest neighbours of terms which the index finds, for choosing trees or search_k
+        approximate = self.query(terms, k=k, trees=trees, search_k=search_k)
+        exact = self.query(terms, k=k, exact=True)
+        found = 0
+        total = 0
+        for (a, e) in zip(approximate, exact):
+            if e is not None:
+                found += len(set(term for (term, sim) in a) & set(term for (term, sim) in e))
+                total += len(e)
+        return found / total if total > 0 else 1.0
+
+
+neighbour_indexes = weakref.WeakKeyDictionary()
+
+
+def neighbour_index(model, path=None, **options):
+    # the NeighbourIndex of model, built once per model (or loaded from path, see NeighbourIndex.from_model) and
+    # built again if the model's vectors have changed since, e.g. by further training
+    index = neighbour_indexes.get(model)
+    if index is not None:
+        (terms, vectors) = vocabulary_of(model)
+        if index.terms != terms or index.digest != vectors_digest(vectors):
+            index = None
+    if index is None:
+        index = NeighbourIndex.from_model(model, path=path, **options)
+        neighbour_indexes[model] = index
+    return index
+
+
+def clear_neighbour_index():
+    neighbour_indexes.clear()
+
+
+def nearest_neighbours(wordset, w2vmodel, k=10, trees=None, search_k=None, exact=None, index=None):
+    # prints the k nearest neighbours of the first 20 words of wordset, all found in one batch from a NeighbourIndex
+    # of the model (index, or one built and kept for the model); trees, search_k and exact are as in NeighbourIndex.search.
+    # The search is exact unless trees or search_k is given: 10 trees find only about half of the true neighbours,
+    # a search_k of about a quarter of the vocabulary nearly all of them (check with NeighbourIndex.recall).  An exact
+    # search without an index ranks the model's vectors directly and builds no index
     threshold = 20
+    if exact is None:
+        exact = trees is None and search_k is None
+    terms = [term for (term, score) in wordset]
+    if exact and index is None:
+        allneighbours = exact_neighbours(terms, w2vmodel, k=k)
+    else:
+        if index is None:
+            index = neighbour_index(w2vmodel)
+        allneighbours = index.query(terms, k=k, trees=trees, search_k=search_k, exact=exact)
     found = 0
-    for i, (term, score) in enumerate(wordset):
-        try:
-            neighbours = w2vmodel.wv.most_similar([term])
+    for i, (term, neighbours) in enumerate(zip(terms, allneighbours)):
+        if neighbours is None:
+            print("{} not in vocab".format(term))
+        else:
             found += 1
             if i < threshold:
                 print(term, neighbours)
-        except:
-            print("{} not in vocab".format(term))
 
     oov = 100 - (found * 100 / len(wordset))
     print("Out of vocabulary: {}".format(oov))
+    return allneighbours
+
+
+# Similarities between the words of a word set come from one product of their normalised embeddings.  Words not in
+# the model's vocabulary have similarity 0 to everything (themselves included) and similarities under threshold are 0.
+# The matrices are cached for each model, so the coherance profile and make_csv of a word set share one.  A cached
+# matrix is only used while the words' vectors (and which of them are in the vocabulary) have the digest it was
+# computed from, so it is recomputed once the model is trained further; clear_similarity_cache frees the cache
+
+similarity_cache = weakref.WeakKeyDictionary()
+SIMILARITY_CACHE_SIZE = 16
+
+
+def clear_similarity_cache():
+    similarity_cache.clear()
+
+
+def known_vectors(terms, model):
+    # the positions of the terms in the model's vocabulary, and their normalised vectors
+    known = np.array([term in model.wv for term in terms], dtype=bool)
+    positions = np.flatnonzero(known)
+    if len(positions) == 0:
+        return positions, np.zeros((0, 0), dtype=np.float32)
+    vectors = np.asarray(model.wv[[terms[i] for i in positions]], dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return positions, vectors / np.where(norms > 0, norms, 1)
+
+
+def similarity_matrix(terms, model, threshold=0.5):
+    # read-only array of the similarities of terms to each other
+    terms = list(terms)
+    key = (tuple(terms), threshold)
+    try:
+        cached = similarity_cache.setdefault(model, {})
+    except TypeError:
+        # models which cannot be weakly referenced are not cached
+        cached = {}
+    positions, vectors = known_vectors(terms, model)
+    digest = vectors_digest(vectors) + hashlib.sha1(positions.tobytes()).hexdigest()
+    (cacheddigest, matrix) = cached.get(key, (None, None))
+    if cacheddigest != digest:
+        matrix = np.zeros((len(terms), len(terms)), dtype=np.float32)
+        if len(positions) > 0:
+            sims = vectors @ vectors.T
+            sims[sims < threshold] = 0
+            matrix[np.ix_(positions, positions)] = sims
+        matrix.setflags(write=False)
+        cached.pop(key, None)
+        if len(cached) >= SIMILARITY_CACHE_SIZE:
+            del cached[next(iter(cached))]
+        cached[key] = (digest, matrix)
+    return matrix
 
 
 def make_matrix(wordset, model, threshold=0.5):
-    matrix = []
-
-    for (termA, _score) in wordset:
-        row = []
-        for (termB, _score) in wordset:
-            try:
-                sim = model.wv.similarity(termA, termB)
-                if sim < threshold:
-                    sim = 0
-            except:
-                sim = 0
-            row.append(sim)
-
-        matrix.append(row)
-    return matrix
+    return similarity_matrix([term for (term, _score) in wordset], model, threshold=threshold)
 
 punctdict = {"\n": "_NEWLINE", ";": "_SEMICOLON", ":": "_COLON", "\"": "_QUOTE", "'s": "_GEN", "-": "_HYPHEN",
              "(": "_LEFTBRACKET", ")": "_RIGHTBRACKET", ",": "_COMMA", ".": "_FULLSTOP", "..": "_DOTDOT"}
@@ -363,36 +923,89 @@ def clean(term):
     return cleanterm
 
 
-def make_csv(wordset, model, filename, threshold=0.5):
-    matrix = make_matrix(wordset, model, threshold=threshold)
-    terms = [clean(term) for (term, score) in wordset]
-
-    # with open(filename,'w') as csvfile:
-    #    csvwriter=csv.writer(csvfile,dialect='excel')
-    #    headings=['']+terms
-    # print(headings)
-    #    csvwriter.writerow(headings)
-    #    for term,row in zip(terms,matrix):
-    #        csvwriter.writerow([term]+row)
-
-    with open(filename, 'w') as csvfile:
-        line = ""
-        for term in terms:
-            line += ';' + term
-        line += '\n'
-
-        csvfile.write(line)
-        # print(line)
-        for term, row in zip(terms, matrix):
-            line = term
-            # print(row)
-            for item in row:
-                line += ';' + str(item)
+# The similarity graph of a word set has a node for each word and an edge between every two words whose similarity is
+# at least the threshold.  The similarities are computed chunksize rows at a time and only the edges are kept, so
+# memory and file size grow with the number of edges rather than with the square of the number of words.  Node labels
+# are cleaned for Gephi, which loads all of the formats
+
+def similarity_edges(wordset, model, threshold=0.5, chunksize=1024):
+    # (i, j, similarity) for each edge between the words at positions i < j of wordset, a chunk of rows at a time
+    terms = [term for (term, _score) in wordset]
+    positions, vectors = known_vectors(terms, model)
+    for start in range(0, len(positions), chunksize):
+        sims = vectors[start:start + chunksize] @ vectors.T
+        # only the upper triangle, without the similarity of a word to itself
+        upper = np.arange(sims.shape[1]) > np.arange(start, start + len(sims))[:, np.newaxis]
+        (rows, cols) = np.nonzero(upper & (sims >= threshold))
+        if len(rows) > 0:
+            yield positions[rows + start], positions[cols], sims[rows, cols]
+
+
+def write_edgelist(outstream, labels, edges):
+    # Gephi's edges table: Source;Target;Weight;Type
+    outstream.write("Source;Target;Weight;Type\n")
+    for (rows, cols, sims) in edges:
+        outstream.write("".join("{};{};{:.6g};Undirected\n".format(labels[i], labels[j], sim)
+                                for (i, j, sim) in zip(rows.tolist(), cols.tolist(), sims.tolist())))
+
+
+def write_gexf(outstream, labels, edges):
+    outstream.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<gexf xmlns="http://www.gexf.net/1.2draft" version="1.2">\n'
+                    '<graph mode="static" defaultedgetype="undirected">\n<nodes>\n')
+    for (i, label) in enumerate(labels):
+        outstream.write('<node id="{}" label={}/>\n'.format(i, quoteattr(label)))
+    outstream.write('</nodes>\n<edges>\n')
+    count = 0
+    for (rows, cols, sims) in edges:
+        outstream.write("".join('<edge id="{}" source="{}" target="{}" weight="{:.6g}"/>\n'.format(count + e, i, j, sim)
+                                for (e, (i, j, sim)) in enumerate(zip(rows.tolist(), cols.tolist(), sims.tolist()))))
+        count += len(rows)
+    outstream.write('</edges>\n</graph>\n</gexf>\n')
+
+
+def write_graphml(outstream, labels, edges):
+    outstream.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+                    '<key id="label" for="node" attr.name="label" attr.type="string"/>\n'
+                    '<key id="weight" for="edge" attr.name="weight" attr.type="double"/>\n'
+                    '<graph edgedefault="undirected">\n')
+    for (i, label) in enumerate(labels):
+        outstream.write('<node id="n{}"><data key="label">{}</data></node>\n'.format(i, escape(label)))
+    for (rows, cols, sims) in edges:
+        outstream.write("".join('<edge source="n{}" target="n{}"><data key="weight">{:.6g}</data></edge>\n'.format(i, j, sim)
+                                for (i, j, sim) in zip(rows.tolist(), cols.tolist(), sims.tolist())))
+    outstream.write('</graph>\n</graphml>\n')
+
+
+graph_writers = {'csv': write_edgelist, 'gexf': write_gexf, 'graphml': write_graphml}
+
+
+def make_graph(wordset, model, filename, threshold=0.5, fileformat=None, chunksize=1024):
+    # write the similarity graph of wordset to filename as an edge list ('csv'), 'gexf' or 'graphml', by default
+    # according to the extension of filename.  Returns the number of edges
+    if fileformat is None:
+        fileformat = os.path.splitext(filename)[1].lstrip('.').lower()
+        if fileformat not in graph_writers:
+            fileformat = 'csv'
+    labels = [clean(term) for (term, score) in wordset]
+    edgecount = 0
+
+    def counted(edges):
+        nonlocal edgecount
+        for chunk in edges:
+            edgecount += len(chunk[0])
+            yield chunk
+
+    with open(filename, 'w') as outstream:
+        graph_writers[fileformat](outstream, labels, counted(similarity_edges(wordset, model, threshold, chunksize)))
+    return edgecount
 
-            line += '\n'
 
-            csvfile.write(line)
-            # print(line)
+def make_csv(wordset, model, filename, threshold=0.5):
+    # the similarity graph of wordset as a Gephi edge list (rather than the full matrix, which grows with the square
+    # of the number of words)
+    return make_graph(wordset, model, filename, threshold=threshold, fileformat='csv')
 
 
 def find_topk(alist, k):
@@ -407,31 +1020,43 @@ def find_topk(alist, k):
         return (sortedlist[1:k + 1])
 
 
-def semantic_coherance(word_set, model, k=1, verbose=True):
+def coherance_scores(word_set, model, ks=(1,)):
+    # semantic_coherance for each k in ks: the average similarity of each word to its k most similar other words
+    # (k=-1 for all of them), as find_topk takes them from each row.  A word whose most similar other word is under the
+    # threshold counts for nothing.  The largest similarities of every row come from a single partition of the matrix
+    n = len(word_set)
+    if n < 2:
+        return [0 for k in ks]
     matrix = make_matrix(word_set, model)
-    # print(matrix)
-    mysum = 0
-    total = 0
-    for row in matrix:
-        topk = find_topk(row, k)
-        mysum += sum(topk)
-        total += len(topk)
-    if total == 0:
-        average = 0
-    else:
-        average = mysum / total
+    # the largest of each row is taken to be the word itself
+    width = min(max([k for k in ks if k > 0], default=1) + 1, n)
+    top = np.sort(np.partition(matrix, n - width, axis=1)[:, n - width:], axis=1)[:, ::-1].astype(np.float64)
+    counted = top[:, 1] > 0
+    scores = []
+    for k in ks:
+        if k == -1:
+            mysum = (matrix.sum(axis=1, dtype=np.float64) - top[:, 0])[counted].sum()
+            total = np.count_nonzero(counted) * (n - 1)
+        else:
+            mysum = top[counted, 1:k + 1].sum()
+            total = np.count_nonzero(counted) * min(k, n - 1)
+        scores.append(mysum / total if total > 0 else 0)
+    return scores
+
+
+def semantic_coherance(word_set, model, k=1, verbose=True):
+    average = coherance_scores(word_set, model, [k])[0]
     if verbose:
         print("Average semantic coherance at k={}: {}".format(k, average))
     return average
 
 
 def coherance_profile(words, model, verbose=True):
-    scores = []
-    scores.append(semantic_coherance(words, model, k=1, verbose=verbose))
-    scores.append(semantic_coherance(words, model, k=2, verbose=verbose))
-    scores.append(semantic_coherance(words, model, k=5, verbose=verbose))
-    scores.append(semantic_coherance(words, model, k=10, verbose=verbose))
-    scores.append(semantic_coherance(words, model, k=-1, verbose=verbose))
+    ks = [1, 2, 5, 10, -1]
+    scores = coherance_scores(words, model, ks)
+    if verbose:
+        for (k, average) in zip(ks, scores):
+            print("Average semantic coherance at k={}: {}".format(k, average))
     return scores
 
 
@@ -585,27 +585,23 @@ class Viewer(SamuelsCorpus):
 
     def make_bow(self, field='vard', k=100000,cutoff=0,displaygraph=False):
         # turn corpus into a bag of words for a certain field - variant of make_hfw_dist()
+        # returns a cf.FreqDist of the k most frequent
 
-        sumdict = {}
-        corpussize = 0
         df = self.get_dataframe()
         df = df[df['LEMMA'] != 'NULL']
         if self.lowercase and field == 'vard':
             field = 'vard_lower'
-        for item in df[field]:
-            sumdict[item] = sumdict.get(item, 0) + 1
-            corpussize += 1
+        dist = cf.FreqDist.from_values(df[field]).top(k)
 
-        print("Size of corpus is {}".format(corpussize))
-        candidates = sorted(sumdict.items(), key=operator.itemgetter(1), reverse=True)
+        print("Size of corpus is {}".format(dist.size))
         if cutoff>0:
-            for cand,score in candidates[:cutoff]:
+            for cand,score in dist.items(cutoff):
                 print("({},{}) : {}".format(cand,score,self.find_text(cand,field=field)))
                 #print("{}:{}".format(cand,score))
 
         if displaygraph:
-            cf.display_list([(corpussize,candidates[:k])],cutoff=cutoff,xlabel=field+' (High Frequency)',colors=self.colors)
-        return corpussize, candidates[:k]
+            cf.display_list([dist],cutoff=cutoff,xlabel=field+' (High Frequency)',colors=self.colors)
+        return dist
 
     def find_text(self, semtag, field='SEMTAG3'):
 
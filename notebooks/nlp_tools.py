@@ -13,11 +13,450 @@ import matplotlib as plt
 get_ipython().magic('matplotlib inline')
 import time
 #nlp=spacy.load('en')
-from collections import defaultdict
-import operator,math
+from collections import defaultdict,Counter,deque
+import operator,math,json,os,shutil,tempfile,weakref,random
+import numpy as np
+from scipy import sparse
+from bisect import bisect_right
+from array import array
+from itertools import islice
+from multiprocessing import Pool
+import sys
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource=None
 from gensim.models import Word2Vec
 
 
+def model_version(nlpmodel):
+    #identify the model so that stored analyses from a different model are not reused
+    meta=getattr(nlpmodel,'meta',None)
+    if isinstance(meta,dict) and 'name' in meta:
+        return "{}_{}-{}".format(meta.get('lang',''),meta['name'],meta.get('version',''))
+    return "spacy-"+spacy.about.__version__
+
+
+def make_record(nlpdoc):
+    #the parts of a parsed document which corpus needs: one list per sentence of
+    #[text, lowercase, pos, lemma, is_stop, is_oov] for each token
+    sents=[]
+    for sent in nlpdoc.sents:
+        sents.append([[token.text,token.text.lower(),token.pos_,token.lemma_,bool(token.is_stop),bool(token.is_oov)] for token in sent])
+    return sents
+
+
+def reservoir_sample(items,size,rng):
+    #a uniform random sample of size of the items, drawn in one pass (reservoir sampling) and returned in their original order
+    reservoir=[]
+    for (n,item) in enumerate(items):
+        if n<size:
+            reservoir.append((n,item))
+        else:
+            j=rng.randrange(n+1)
+            if j<size:
+                reservoir[j]=(n,item)
+    reservoir.sort(key=operator.itemgetter(0))
+    return [item for (n,item) in reservoir]
+
+
+def count_lines(path):
+    with open(path) as instream:
+        return sum(1 for line in instream)
+
+
+def pipe(nlpmodel,texts,batch_size=0,n_process=1):
+    #parse texts with nlpmodel.pipe, yielding the parsed documents in the order of texts.
+    #batch_size=0 leaves spacy's default batch size; n_process>1 needs a spacy version with multiprocess pipe
+    kwargs={}
+    if batch_size>0:
+        kwargs['batch_size']=batch_size
+    if n_process>1:
+        kwargs['n_process']=n_process
+    return nlpmodel.pipe(texts,**kwargs)
+
+
+# The analysis metrics record where the time goes when a corpus is analysed: wall and cpu time for each stage (reading the source files, looking analyses up in the stores and cache, parsing, extracting the records, counting ...), documents and tokens per second and peak memory.
+
+class AnalysisMetrics:
+    #stage(name) is a context manager timing one stage.  Time spent in a stage entered inside another (e.g. reading the
+    #documents which nlp.pipe pulls in while parsing) is counted only in the inner one.  With n_process>1 the cpu time
+    #of the parsing processes is not included.  If path is given, emit() appends a JSON line to it
+    
+    def __init__(self,path=None):
+        self.path=path
+        self.wall=defaultdict(float)
+        self.cpu=defaultdict(float)
+        self.calls=defaultdict(int)
+        self.start()
+        
+    def start(self):
+        #start again from nothing
+        self.wall.clear()
+        self.cpu.clear()
+        self.calls.clear()
+        self.inner=[]
+        self.docs=0
+        self.tokens=0
+        self.started=(time.perf_counter(),time.process_time())
+        
+    def add(self,docs,tokens):
+        self.docs+=docs
+        self.tokens+=tokens
+        
+    @contextmanager
+    def stage(self,name):
+        wall=time.perf_counter()
+        cpu=time.process_time()
+        self.inner.append([0.0,0.0])
+        try:
+            yield
+        finally:
+            (innerwall,innercpu)=self.inner.pop()
+            wall=time.perf_counter()-wall
+            cpu=time.process_time()-cpu
+            self.wall[name]+=wall-innerwall
+            self.cpu[name]+=cpu-innercpu
+            self.calls[name]+=1
+            if self.inner:
+                self.inner[-1][0]+=wall
+                self.inner[-1][1]+=cpu
+                
+    def timed(self,iterable,name):
+        #the items of iterable, timing each step as the stage name
+        iterator=iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item=next(iterator)
+                except StopIteration:
+                    return
+            yield item
+            
+    def summary(self):
+        #everything since start() as a dict
+        (wall,cpu)=self.started
+        wall=time.perf_counter()-wall
+        cpu=time.process_time()-cpu
+        return {'docs':self.docs,'tokens':self.tokens,'wall':wall,'cpu':cpu,
+                'docs_per_sec':self.docs/wall if wall>0 else 0,'tokens_per_sec':self.tokens/wall if wall>0 else 0,
+                'peak_memory_mb':peak_memory(),
+                'stages':{name:{'wall':self.wall[name],'cpu':self.cpu[name],'calls':self.calls[name]} for name in self.wall}}
+    
+    def emit(self,event,**extra):
+        record=dict(self.summary(),event=event,time=time.time(),**extra)
+        if self.path is not None:
+            with open(self.path,'a') as outstream:
+                outstream.write(json.dumps(record)+"\n")
+        return record
+    
+    
+def peak_memory():
+    #peak resident memory of this process in MB, or None where the resource module is not available
+    if resource is None:
+        return None
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on Linux, bytes on macOS
+    return peak/(1024*1024) if sys.platform=='darwin' else peak/1024
+
+
+# The entity index collects the named entities found when a corpus is analysed with ner=True, so that they can be queried without re-parsing or printing every sentence.
+
+class EntityIndex:
+    #each mention is stored as integers in parallel arrays: entity text id, label id, document (an index into corpus.docs),
+    #sentence (an index into corpus.sentences) and token span [start,end) within the document
+    
+    def __init__(self):
+        self.texts=[]
+        self.textids={}
+        self.labels=[]
+        self.labelids={}
+        self.textcol=array('l')
+        self.labelcol=array('l')
+        self.doccol=array('l')
+        self.sentcol=array('l')
+        self.startcol=array('l')
+        self.endcol=array('l')
+        self.bylabel=defaultdict(list)
+        self.bytext=defaultdict(list)
+        self.freqs={}
+        
+    def __len__(self):
+        return len(self.doccol)
+    
+    def intern(self,value,values,ids):
+        i=ids.get(value)
+        if i is None:
+            i=len(values)
+            ids[value]=i
+            values.append(value)
+        return i
+    
+    def add_doc(self,nlpdoc,docid,firstsent=0):
+        #firstsent is the index in corpus.sentences of the first sentence of nlpdoc
+        sentstarts=[sent.start for sent in nlpdoc.sents]
+        for ent in nlpdoc.ents:
+            sentid=firstsent+bisect_right(sentstarts,ent.start)-1
+            self.add(ent.text,ent.label_,docid,sentid,ent.start,ent.end)
+            
+    def add(self,text,label,docid,sentid,start,end):
+        m=len(self)
+        labelid=self.intern(label,self.labels,self.labelids)
+        self.textcol.append(self.intern(text,self.texts,self.textids))
+        self.labelcol.append(labelid)
+        self.doccol.append(docid)
+        self.sentcol.append(sentid)
+        self.startcol.append(start)
+        self.endcol.append(end)
+        self.bylabel[labelid].append(m)
+        self.bytext[text.lower()].append(m)
+        self.freqs={}
+        
+    def mention(self,m):
+        return (self.texts[self.textcol[m]],self.labels[self.labelcol[m]],self.doccol[m],self.sentcol[m],self.startcol[m],self.endcol[m])
+    
+    def label_ids(self,labels):
+        #labels may be a single label or a list of them
+        if isinstance(labels,str):
+            labels=[labels]
+        return sorted(self.labelids[label] for label in set(labels) if label in self.labelids)
+    
+    def mention_ids(self,labels=None):
+        if labels is None:
+            return range(len(self))
+        return sorted(m for labelid in self.label_ids(labels) for m in self.bylabel[labelid])
+    
+    def mentions(self,labels=None):
+        #(text, label, document, sentence, start, end) of every mention with one of the labels, in document order
+        return [self.mention(m) for m in self.mention_ids(labels)]
+    
+    def locations(self):
+        return self.mentions(corpus.loctypes)
+    
+    def documents(self,text,labels=None):
+        #the documents mentioning the entity text (ignoring case), optionally only as one of the labels
+        found=self.bytext.get(text.lower(),[])
+        if labels is not None:
+            keep=set(self.label_ids(labels))
+            found=[m for m in found if self.labelcol[m] in keep]
+        return sorted(set(self.doccol[m] for m in found))
+    
+    def frequencies(self,labels=None):
+        #[(entity text, number of mentions)] for the labels, most frequent first.  Cached until the next add
+        key=None if labels is None else tuple(self.label_ids(labels))
+        if key not in self.freqs:
+            counts=defaultdict(int)
+            for m in self.mention_ids(labels):
+                counts[self.textcol[m]]+=1
+            self.freqs[key]=sorted(((self.texts[t],count) for (t,count) in counts.items()),key=operator.itemgetter(1),reverse=True)
+        return self.freqs[key]
+    
+    def label_counts(self):
+        #number of mentions of each label, grouped into the location types (corpus.loctypes) and the others
+        groups={'locations':{},'other':{}}
+        for (labelid,found) in self.bylabel.items():
+            label=self.labels[labelid]
+            groups['locations' if label in corpus.loctypes else 'other'][label]=len(found)
+        return groups
+
+
+# Sentences are stored as ids into a vocabulary shared by the corpus, rather than as lists of strings.  A SentenceStore behaves like a list of sentences (each a list of strings), decoding each sentence when it is accessed, so it can be passed to Word2Vec as before.
+
+class Vocabulary:
+    
+    def __init__(self):
+        self.strings=[]
+        self.ids={}
+        
+    def __len__(self):
+        return len(self.strings)
+    
+    def __getitem__(self,i):
+        return self.strings[i]
+    
+    def intern(self,string):
+        i=self.ids.get(string)
+        if i is None:
+            i=len(self.strings)
+            self.ids[string]=i
+            self.strings.append(string)
+        return i
+    
+
+class SentenceStore:
+    #the tokens of all sentences as one uint32 array of vocabulary ids, with the start of each sentence in offsets.
+    #With parts>1 each token is a tuple of that many strings (e.g. (word,pos)), decoded joined by sep (word_POS).
+    #With a spillfile, spill() moves the sentences held in memory to the end of <spillfile>.ids and <spillfile>.lens;
+    #iterating replays the spilled sentences from disk before the ones in memory, but only the latter can be indexed
+    
+    def __init__(self,vocab,parts=1,sep="_",spillfile=None):
+        self.vocab=vocab
+        self.parts=parts
+        self.sep=sep
+        self.ids=array('I')
+        self.offsets=array('Q',[0])
+        self.spillfile=spillfile
+        self.spilled=0
+        if spillfile is not None:
+            open(spillfile+".ids",'wb').close()
+            open(spillfile+".lens",'wb').close()
+        
+    def __len__(self):
+        return self.spilled+len(self.offsets)-1
+    
+    def append(self,sent):
+        if self.parts==1:
+            self.ids.extend(self.vocab.intern(token) for token in sent)
+        else:
+            for token in sent:
+                self.ids.extend(self.vocab.intern(part) for part in token)
+        self.offsets.append(len(self.ids))
+        
+    def spill(self):
+        if self.spillfile is None or len(self.offsets)==1:
+            return
+        lens=array('Q',(self.offsets[k+1]-self.offsets[k] for k in range(len(self.offsets)-1)))
+        with open(self.spillfile+".ids",'ab') as outstream:
+            self.ids.tofile(outstream)
+        with open(self.spillfile+".lens",'ab') as outstream:
+            lens.tofile(outstream)
+        self.spilled+=len(lens)
+        self.ids=array('I')
+        self.offsets=array('Q',[0])
+        
+    def local(self,i):
+        #the position in memory of sentence i
+        if i<0:
+            i+=len(self)
+        if not 0<=i<len(self):
+            raise IndexError("sentence index out of range")
+        if i<self.spilled:
+            raise IndexError("sentence {} has been spilled to disk, iterate over the store to replay it".format(i))
+        return i-self.spilled
+        
+    def token_ids(self,i):
+        #the vocabulary ids of sentence i without decoding (parts ids per token)
+        i=self.local(i)
+        return memoryview(self.ids)[self.offsets[i]:self.offsets[i+1]]
+    
+    def decode_ids(self,ids):
+        strings=self.vocab.strings
+        if self.parts==1:
+            return [strings[j] for j in ids]
+        return [self.sep.join(strings[j] for j in ids[k:k+self.parts]) for k in range(0,len(ids),self.parts)]
+    
+    def decode(self,i):
+        #i is a position in memory
+        return self.decode_ids(self.ids[self.offsets[i]:self.offsets[i+1]])
+    
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return [self.decode(self.local(j)) for j in range(*i.indices(len(self)))]
+        return self.decode(self.local(i))
+    
+    def replay(self,chunksize=65536):
+        #the spilled sentences, read back chunksize sentences at a time
+        with open(self.spillfile+".lens",'rb') as lensstream, open(self.spillfile+".ids",'rb') as idsstream:
+            for start in range(0,self.spilled,chunksize):
+                lens=array('Q')
+                lens.fromfile(lensstream,min(chunksize,self.spilled-start))
+                ids=array('I')
+                ids.fromfile(idsstream,sum(lens))
+                offset=0
+                for length in lens:
+                    yield self.decode_ids(ids[offset:offset+length])
+                    offset+=length
+    
+    def __iter__(self):
+        if self.spilled>0:
+            yield from self.replay()
+        for i in range(len(self.offsets)-1):
+            yield self.decode(i)
+
+
+# The parsed store keeps the analyses of the documents of a source file in <sourcefile>.parsed/ so that a corpus loaded from files (loadfiles=True, store=True) does not parse them again.
+
+class ParsedStore:
+    #the make_record() fields of every token as one fixed-width array (text, pos and lemma as ids into strings.json,
+    #is_stop and is_oov as flag bits), with the token offsets of the sentences and the sentence offsets of the documents.
+    #meta.json records the size and modification time of the source file and the model version: if either has changed
+    #the store is ignored and rewritten.  The store holds the first documents of the file, as many as have been analysed
+    
+    dtype=np.dtype([('text','<u4'),('pos','<u4'),('lemma','<u4'),('flags','u1')])
+    STOP=1
+    OOV=2
+    VERSION=1
+    
+    def __init__(self,sourcefile,nlpmodel):
+        self.sourcefile=sourcefile
+        self.path=sourcefile+".parsed"
+        self.version=model_version(nlpmodel)
+        
+    def stamp(self):
+        stat=os.stat(self.sourcefile)
+        return {'format':ParsedStore.VERSION,'size':stat.st_size,'mtime':stat.st_mtime_ns,'model':self.version}
+    
+    def load(self):
+        #the records of the first documents of the source file, or [] if there is no up to date store
+        metafile=os.path.join(self.path,'meta.json')
+        if not os.path.exists(metafile):
+            return []
+        with open(metafile) as instream:
+            meta=json.load(instream)
+        if meta['source']!=self.stamp():
+            print("Parsed store {} is out of date".format(self.path))
+            return []
+        with open(os.path.join(self.path,'strings.json')) as instream:
+            strings=json.load(instream)
+        lowers=[string.lower() for string in strings]
+        tokens=np.load(os.path.join(self.path,'tokens.npy'))
+        sents=np.load(os.path.join(self.path,'sents.npy')).tolist()
+        docs=np.load(os.path.join(self.path,'docs.npy')).tolist()
+        text=tokens['text'].tolist()
+        pos=tokens['pos'].tolist()
+        lemma=tokens['lemma'].tolist()
+        stop=(tokens['flags']&ParsedStore.STOP).astype(bool).tolist()
+        oov=(tokens['flags']&ParsedStore.OOV).astype(bool).tolist()
+        records=[]
+        for d in range(len(docs)-1):
+            record=[]
+            for s in range(docs[d],docs[d+1]):
+                record.append([[strings[text[t]],lowers[text[t]],strings[pos[t]],strings[lemma[t]],stop[t],oov[t]] for t in range(sents[s],sents[s+1])])
+            records.append(record)
+        print("Loaded {} parsed documents from {}".format(len(records),self.path))
+        return records
+    
+    def save(self,records):
+        strings=Vocabulary()
+        rows=[]
+        sents=[0]
+        docs=[0]
+        for record in records:
+            for sent in record:
+                for (text,lower,pos,lemma,is_stop,is_oov) in sent:
+                    flags=(ParsedStore.STOP if is_stop else 0)|(ParsedStore.OOV if is_oov else 0)
+                    rows.append((strings.intern(text),strings.intern(pos),strings.intern(lemma),flags))
+                sents.append(len(rows))
+            docs.append(len(sents)-1)
+        #write to a temporary directory and move it into place so that a failed write leaves no half store
+        tmpdir=self.path+".tmp"
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir)
+        os.makedirs(tmpdir)
+        np.save(os.path.join(tmpdir,'tokens.npy'),np.array(rows,dtype=ParsedStore.dtype))
+        np.save(os.path.join(tmpdir,'sents.npy'),np.array(sents,dtype=np.int64))
+        np.save(os.path.join(tmpdir,'docs.npy'),np.array(docs,dtype=np.int64))
+        with open(os.path.join(tmpdir,'strings.json'),'w') as outstream:
+            json.dump(strings.strings,outstream)
+        with open(os.path.join(tmpdir,'meta.json'),'w') as outstream:
+            json.dump({'source':self.stamp(),'documents':len(records)},outstream)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(tmpdir,self.path)
+        print("Saved {} parsed documents to {}".format(len(records),self.path))
+
+
 # The corpus class loads in, stores and performs basic nlp analysis on a corpus.  The data structures generated during basic analysis can be accessed for further analysis and visualisation.
 
 # In[82]:
@@ -25,11 +464,42 @@ from gensim.models import Word2Vec
 class corpus:
     
     loctypes=["LOC","GPE","FAC"]
+    samplemodes=[None,"uniform","stratified"]
     
-    def __init__(self,ipfiles,nlpmodel,prop=10,ner=False,loadfiles=True,paired=False):
+    def __init__(self,ipfiles,nlpmodel,prop=10,ner=False,loadfiles=True,paired=False,batch_size=0,n_process=1,store=False,
+                 stream=False,spilldir=None,spillsize=1000,sample=None,samplesize=None,seed=None,metricsfile=None):
         #default mode is to load in 10%.  Set prop = 100 to load in whole corpus
+        #batch_size>0 or n_process>1 parses the documents in batches with nlp.pipe (see basic_analyse_all)
+        #store=True (with loadfiles) reuses and updates a ParsedStore next to each source file.  Documents which
+        #come from a store are not parsed, so their entry in nlpdocs is None
+        #stream=True keeps memory bounded by spillsize rather than by the size of the corpus: documents (and labels) are
+        #read from the source files as they are analysed and neither they nor nlpdocs are kept, and every spillsize
+        #documents the sentence lists are spilled to files in spilldir (a temporary directory by default).
+        #Parsed stores are not used when streaming
+        #sample="uniform" analyses a uniform random sample of prop% (or samplesize) of the documents instead of the first
+        #prop%, drawn with reservoir sampling; sample="stratified" samples prop% of each source file.  seed makes the
+        #sample repeatable.  Turning prop into a sample size needs the number of lines, so the source files are read
+        #twice (counted, then sampled) unless samplesize is given, which makes uniform sampling a single pass.
+        #Parsed stores are not used when sampling
+        #self.metrics times each stage of the analysis (see AnalysisMetrics); metricsfile adds its JSON lines to a file
+        self.metrics=AnalysisMetrics(metricsfile)
         self.sourcefiles=ipfiles
         self.nlp=nlpmodel
+        self.stream=stream
+        self.spillsize=spillsize if stream else 0
+        self.store=store and loadfiles and not stream and sample is None
+        if sample not in corpus.samplemodes:
+            raise ValueError("Unknown sample mode {!r}, expected one of {}".format(sample,corpus.samplemodes))
+        self.sample=sample
+        self.samplesize=samplesize
+        self.seed=seed
+        if sample is not None:
+            #the sample is analysed in full
+            self.sampleprop=prop
+            prop=100
+        self.spans=[]
+        self.stored=[]
+        self.records=None
         self.prop=prop
         self.name=""
         self.paired=paired
@@ -46,10 +516,19 @@ class corpus:
         self.wordlengths=defaultdict(int)
         self.sentencelengths=defaultdict(int)
         self.doclengths=defaultdict(int)
-        self.sentences=[]
-        self.content_sentences=[]
-        self.pos_sentences=[]
-        self.worddocdict=defaultdict(set)
+        self.vocab=Vocabulary()
+        spillfiles={}
+        if stream:
+            if spilldir is None:
+                spilldir=tempfile.mkdtemp(prefix="corpus_")
+                weakref.finalize(self,shutil.rmtree,spilldir,True)
+            spillfiles={name:os.path.join(spilldir,name) for name in ('sentences','content_sentences','pos_sentences')}
+        self.sentences=SentenceStore(self.vocab,spillfile=spillfiles.get('sentences'))
+        self.content_sentences=SentenceStore(self.vocab,spillfile=spillfiles.get('content_sentences'))
+        self.pos_sentences=SentenceStore(self.vocab,parts=2,spillfile=spillfiles.get('pos_sentences'))
+        self.entities=EntityIndex()
+        #in paired mode, the number of occurrences of each lemma with each label (its document frequency is the number of labels)
+        self.doctermmatrix=LabelLemmaMatrix()
         
         self.wordtotal=0
         self.nountotal=0
@@ -58,75 +537,307 @@ class corpus:
         self.adjtotal=0
         self.advtotal=0
         
-        if loadfiles:
-            self.initialise()
+        if loadfiles and sample is not None:
+            with self.metrics.stage('load'):
+                self.initialise_sample()
+        elif loadfiles:
+            with self.metrics.stage('load'):
+                self.initialise()
         else:
             self.docs=ipfiles
+            if sample is not None:
+                self.docs=reservoir_sample(ipfiles,self.sample_size(len(ipfiles)),random.Random(seed))
+            self.ndocs=len(self.docs)
             self.name="unknown"
-        self.basic_analyse_all(ner=ner)
+        self.basic_analyse_all(ner=ner,batch_size=batch_size,n_process=n_process)
         
     def initialise(self):
         print("Loading sourcefiles")
+        self.ndocs=0
+        if self.paired:
+            self.labels=[]
         for ipf in self.sourcefiles:
+            start=self.ndocs
             with open(ipf) as instream:
                 self.name+="_"+ipf
-                if self.paired:
-                    self.labels=[]
+                if self.stream:
+                    for line in instream:
+                        self.ndocs+=1
+                elif self.paired:
                     for line in instream:
-                        parts=line.split('\t')
-                        self.docs.append(parts[0].rstrip())
-                        self.labels.append(parts[1])
+                        (doc,label)=self.split_line(line)
+                        self.docs.append(doc)
+                        self.labels.append(label)
+                        self.ndocs+=1
                 else:
                     for line in instream:
                         self.docs.append(line.rstrip())
+                        self.ndocs+=1
+            self.spans.append((ipf,start,self.ndocs))
+            if self.store:
+                stored=ParsedStore(ipf,self.nlp).load()
+                self.stored.extend(stored+[None]*(self.ndocs-start-len(stored)))
+        if self.store:
+            self.records=[None]*self.ndocs
+                
+    def split_line(self,line):
+        #(document, label) of a line of a source file
+        if self.paired:
+            parts=line.split('\t')
+            return (parts[0].rstrip(),parts[1])
+        return (line.rstrip(),"none")
+    
+    def sample_size(self,total):
+        if self.samplesize is not None:
+            return self.samplesize
+        return math.ceil(self.sampleprop*total/100)
+                
+    def initialise_sample(self):
+        #a reservoir sample of the lines of the source files, in file order.  Only the sample is kept in memory
+        print("Sampling sourcefiles")
+        rng=random.Random(self.seed)
+        lines=[]
+        for ipf in self.sourcefiles:
+            self.name+="_"+ipf
+            if self.sample=="stratified":
+                with open(ipf) as instream:
+                    lines.extend(reservoir_sample(instream,math.ceil(self.sampleprop*count_lines(ipf)/100),rng))
+        if self.sample=="uniform":
+            #with a samplesize the files are read only once; otherwise their lines are counted first
+            size=self.samplesize
+            if size is None:
+                size=self.sample_size(sum(count_lines(ipf) for ipf in self.sourcefiles))
+            lines=reservoir_sample(self.read_lines(),size,rng)
+        self.docs=[]
+        self.labels=[]
+        for line in lines:
+            (doc,label)=self.split_line(line)
+            self.docs.append(doc)
+            self.labels.append(label)
+        self.ndocs=len(self.docs)
+        print("Sampled {} documents".format(self.ndocs))
+        
+    def read_lines(self):
+        for ipf in self.sourcefiles:
+            with open(ipf) as instream:
+                for line in instream:
+                    yield line
+                
+    def iter_docs(self):
+        #(document, label) in order; when streaming from files they are read again rather than kept
+        if self.stream and self.spans:
+            for line in self.read_lines():
+                yield self.split_line(line)
+        else:
+            for i,doc in enumerate(self.docs):
+                if self.paired:
+                    yield (doc,self.labels[i])
+                else:
+                    yield (doc,"none")
                 
        
     
-    def basic_analyse_all(self,ner=False):
+    def basic_analyse_all(self,ner=False,batch_size=0,n_process=1):
+        #with batch_size>0 or n_process>1 the documents are parsed with nlp.pipe instead of one at a time.
+        #The parsed documents come back in order and are added exactly as in the serial loop, so the results are the same
         if ner:
+            #named entities are collected in self.entities
             print ("Running basic analysis with NER")
         else:
             print("Running basic analysis")
-        todo=len(self.docs)
+        todo=self.ndocs
         if self.prop<10:
             tenpercent=((todo*self.prop)//100)+1
         else:
             tenpercent=(todo//10)+1
         print("Analysing {}%. Chunks of size {}".format(self.prop,tenpercent))
         self.count=0        
-        for i,doc in enumerate(self.docs):
-            if self.paired:
-                label=self.labels[i]
-            else:
-                label="none"
-            nlpdoc=self.basic_analyse_single(doc,label=label)
-            self.nlpdocs.append(nlpdoc)
-            if ner:
-                self.explore_ner(nlpdoc,self.count)
-        
-            if self.count%tenpercent==0:
-                done=self.count*100/todo
-                print("Completed {} docs ({}% complete)".format(str(self.count),str(done)))
-                if done >= self.prop:
-                    break
+        docs=islice(enumerate(self.metrics.timed(self.iter_docs(),'read')),self.analysis_limit(todo,tenpercent))
+        self.analyse_docs(docs,ner=ner,batch_size=batch_size,n_process=n_process,tenpercent=tenpercent,todo=todo)
         if self.paired:
             print("Calculating document frequencies ....")
-            self.docfreq={}
-            for key in self.worddocdict.keys():
-                self.docfreq[key]=len(self.worddocdict[key])
+            with self.metrics.stage('docfreq'):
+                self.update_docfreq()
         
         print("Number of documents is {}".format(self.count))
+        if ner:
+            print("Number of entity mentions is {}".format(len(self.entities)))
+        if self.store:
+            with self.metrics.stage('save'):
+                self.save_stores()
+        self.print_metrics(self.metrics.emit('analysed',name=self.name))
         #print("Distribution of document lengths is {}".format(str(self.doclengths)))
         #print("Distribution of sentence lengths is {}".format(str(self.sentencelengths)))
         #print("Distribution of word lengths is {}".format(str(self.wordlengths)))
         #print("Number of docs with 1 sentence is {}".format(self.doclengths[1]))
         
-    def basic_analyse_single(self,doc,label="none"):
+    def update_docfreq(self):
+        self.docfreq=self.doctermmatrix.docfreq()
+        
+    @property
+    def worddocdict(self):
+        #lemma -> {label: count}, made from doctermmatrix
+        return self.doctermmatrix.to_dict()
+        
+    def analyse_docs(self,docs,ner=False,batch_size=0,n_process=1,tenpercent=0,todo=0):
+        #analyse (position, (document, label)) pairs in order and add them to the counts, printing progress every
+        #tenpercent documents
+        if batch_size>0 or n_process>1:
+            print("Parsing in batches of {} with {} processes".format(batch_size,n_process))
+            analysed=self.pipe_all(docs,ner,batch_size,n_process)
+        else:
+            analysed=((i,doc,label,None) for (i,(doc,label)) in docs)
+        metrics=self.metrics
+        for (i,doc,label,nlpdoc) in analysed:
+            firstsent=len(self.sentences)
+            with metrics.stage('lookup'):
+                record=None if ner else self.stored_record(i)
+            nlpdoc=self.basic_analyse_single(doc,label=label,nlpdoc=nlpdoc,record=record)
+            if not self.stream:
+                self.nlpdocs.append(nlpdoc)
+            if ner:
+                with metrics.stage('ner'):
+                    self.entities.add_doc(nlpdoc,i,firstsent)
+            if self.spillsize>0 and self.count%self.spillsize==0:
+                with metrics.stage('spill'):
+                    self.spill()
+            if tenpercent>0 and self.count%tenpercent==0:
+                done=self.count*100/todo
+                print("Completed {} docs ({}% complete)".format(str(self.count),str(done)))
+                metrics.emit('progress',name=self.name,done=done)
+                
+    def print_metrics(self,summary):
+        print("Analysed {} docs ({} tokens) in {:.2f}s: {:.1f} docs/sec, {:.1f} tokens/sec, peak memory {} MB".format(
+            summary['docs'],summary['tokens'],summary['wall'],summary['docs_per_sec'],summary['tokens_per_sec'],summary['peak_memory_mb']))
+        for (name,stage) in sorted(summary['stages'].items(),key=lambda item:-item[1]['wall']):
+            print("  {}: {:.2f}s wall, {:.2f}s cpu, {} calls".format(name,stage['wall'],stage['cpu'],stage['calls']))
+                
+    def pipe_all(self,docs,needdoc,batch_size,n_process):
+        #(position, document, label, parsed document) for each (position, (document, label)) in docs in order, parsing the
+        #documents which are not in the parsed stores with nlp.pipe (the parsed document is None for the others).
+        #nlp.pipe reads ahead, so the documents it has read are queued until their turn
+        queue=deque()
+        parsed=deque()
+        def toparse():
+            for (i,(doc,label)) in docs:
+                stored=not needdoc and self.stored_record(i) is not None
+                queue.append((i,doc,label,stored))
+                if not stored:
+                    yield doc
+        nlpdocs=self.metrics.timed(pipe(self.nlp,toparse(),batch_size=batch_size,n_process=n_process),'parse')
+        while True:
+            if not queue:
+                #nothing read ahead: reading the next parsed document reads more documents
+                nlpdoc=next(nlpdocs,None)
+                if nlpdoc is not None:
+                    parsed.append(nlpdoc)
+                if not queue:
+                    return
+            (i,doc,label,stored)=queue.popleft()
+            if stored:
+                yield (i,doc,label,None)
+            else:
+                yield (i,doc,label,parsed.popleft() if parsed else next(nlpdocs))
+                
+    def add_documents(self,docs,labels=None,ner=False,batch_size=0,n_process=1):
+        #analyse further documents (with their labels in paired mode) and add them to every count, total, histogram,
+        #sentence list, doctermmatrix and docfreq in place.  They are appended to self.docs (unless streaming), after any
+        #documents which prop left unanalysed
+        if labels is None:
+            items=((doc,"none") for doc in docs)
+        else:
+            items=zip(docs,labels)
+        self.add_items(items,ner=ner,batch_size=batch_size,n_process=n_process)
+        
+    def add_files(self,ipfiles,ner=False,batch_size=0,n_process=1):
+        #add_documents for the lines of further source files, read as they are analysed
+        def items():
+            for ipf in ipfiles:
+                with open(ipf) as instream:
+                    for line in instream:
+                        yield self.split_line(line)
+        for ipf in ipfiles:
+            self.name+="_"+ipf
+        self.add_items(items(),ner=ner,batch_size=batch_size,n_process=n_process)
         
+    def add_items(self,items,ner=False,batch_size=0,n_process=1):
+        #self.metrics starts again and covers only these documents
+        self.metrics.start()
+        items=self.metrics.timed(items,'read')
+        if not self.stream:
+            items=list(items)
+            if self.docs is self.sourcefiles:
+                #do not extend the list the corpus was made from
+                self.docs=list(self.docs)
+            self.docs.extend(doc for (doc,label) in items)
+            if self.paired:
+                self.labels.extend(label for (doc,label) in items)
+        start=self.ndocs
+        def numbered():
+            for item in items:
+                yield (self.ndocs,item)
+                self.ndocs+=1
+        self.analyse_docs(numbered(),ner=ner,batch_size=batch_size,n_process=n_process)
+        if self.paired:
+            with self.metrics.stage('docfreq'):
+                self.update_docfreq()
+        print("Added {} documents, number of documents is {}".format(self.ndocs-start,self.count))
+        self.print_metrics(self.metrics.emit('added',name=self.name))
+        
+    def spill(self):
+        for sentences in (self.sentences,self.content_sentences,self.pos_sentences):
+            sentences.spill()
+
+    def analysis_limit(self,todo,tenpercent):
+        #the number of documents analysed before stopping at self.prop: the first multiple of tenpercent at or over prop%
+        limit=tenpercent
+        while limit<todo and limit*100/todo<self.prop:
+            limit+=tenpercent
+        return min(limit,todo)
+
+    def stored_record(self,i):
+        #the record of document i from the parsed stores, if there is one
+        if i is not None and i<len(self.stored):
+            return self.stored[i]
+        return None
+
+    def save_stores(self):
+        #rewrite the store of each source file which now has more of its documents analysed than its store holds
+        for (ipf,start,end) in self.spans:
+            analysed=start
+            while analysed<end and self.records[analysed] is not None:
+                analysed+=1
+            stored=start
+            while stored<end and self.stored[stored] is not None:
+                stored+=1
+            if analysed>stored:
+                ParsedStore(ipf,self.nlp).save(self.records[start:analysed])
+        self.records=None
+        self.stored=[]
+
+    def basic_analyse_single(self,doc,label="none",nlpdoc=None,record=None):
+        #nlpdoc is doc already parsed (by nlp.pipe) and record its analysis if already known (from a parsed store),
+        #otherwise doc is parsed here.  Returns the parsed document, or None if the analysis came from a store
+        metrics=self.metrics
         self.count+=1
-        nlpdoc=self.nlp(doc)
+        if record is None:
+            if nlpdoc is None:
+                with metrics.stage('parse'):
+                    nlpdoc=self.nlp(doc)
+            with metrics.stage('extract'):
+                record=make_record(nlpdoc)
+        words=self.wordtotal
+        with metrics.stage('count'):
+            self.add_record(record,label=label)
+        metrics.add(1,self.wordtotal-words)
+        return nlpdoc
+        
+    def add_record(self,record,label="none"):
+        if self.records is not None:
+            #kept for the parsed stores; self.count is the number of this document
+            self.records[self.count-1]=record
         nosents=0
-        for sent in nlpdoc.sents:
+        for sent in record:
             sent_text=[]
             content_text=[]
             pos_text=[]
@@ -135,44 +846,43 @@ class corpus:
             #    print(sent)
             self.sentencelengths[slength]+=1
             nosents+=1
-            for token in sent:
+            for (text,lower,pos,lemma,is_stop,is_oov) in sent:
                 
-                wordlength=len(token)
+                wordlength=len(text)
                 self.wordlengths[wordlength]+=1
                 self.wordtotal+=1
                 
-                self.allworddict[token.text.lower()]+=1
-                self.wordposdict[(token.text.lower(),token.pos_)]+=1
-                sent_text.append(token.text.lower())
-                pos_text.append(token.text.lower()+"_"+token.pos_)
-                if not token.is_stop and not token.is_oov and not token.pos_=="PUNCT":
-                    self.worddict[token.lemma_]+=1
-                    content_text.append(token.lemma_)
-                    if token.pos_ =="NOUN":
-                        self.noundict[token.lemma_]+=1
+                self.allworddict[lower]+=1
+                self.wordposdict[(lower,pos)]+=1
+                sent_text.append(lower)
+                pos_text.append((lower,pos))
+                if not is_stop and not is_oov and not pos=="PUNCT":
+                    self.worddict[lemma]+=1
+                    content_text.append(lemma)
+                    if pos =="NOUN":
+                        self.noundict[lemma]+=1
                         self.nountotal+=1
-                    elif token.pos_ =="PROPN":
-                        self.propnoundict[token.lemma_]+=1
+                    elif pos =="PROPN":
+                        self.propnoundict[lemma]+=1
                         self.propnountotal+=1
-                    elif token.pos_=="VERB":
-                        self.verbdict[token.lemma_]+=1
+                    elif pos=="VERB":
+                        self.verbdict[lemma]+=1
                         self.verbtotal+=1
-                    elif token.pos_=="ADJ":
-                        self.adjdict[token.lemma_]+=1
+                    elif pos=="ADJ":
+                        self.adjdict[lemma]+=1
                         self.adjtotal+=1
-                    elif token.pos_=="ADV":
-                        self.advdict[token.lemma_]+=1
+                    elif pos=="ADV":
+                        self.advdict[lemma]+=1
                         self.advtotal+=1
                         
                 if not label=="none":
-                    self.worddocdict[token.lemma_].add(label)
+                    self.doctermmatrix.add(label,lemma)
                         
             self.sentences.append(sent_text)    
             self.content_sentences.append(content_text)
             self.pos_sentences.append(pos_text)
         #print("Number of sentences is {}".format(nosents))
         self.doclengths[nosents]+=1
-        return nlpdoc
         
     def get_word_distribution(self,wordtype):
         
@@ -187,12 +897,18 @@ class corpus:
         else:
             return(self.worddict,self.wordtotal)
 
+    def stats(self):
+        #a CorpusStats copy of the counts, which can be added to or subtracted from those of other corpora
+        return CorpusStats(self)
+
     def get_sentences(self):
         for sent in self.sentences:
             yield sent
             
             
     def explore_ner(self,doc,number):
+        #prints the sentences of doc which contain a location token by token.  Analysis with ner=True collects
+        #the entities into self.entities instead of calling this
         for sent in doc.sents:
             containsloc=False
             for token in sent:
@@ -210,6 +926,229 @@ class corpus:
         
 
 
+# In paired mode the occurrences of each lemma with each label are counted in a sparse label x lemma matrix, from which document frequencies, per-label frequencies and TF-IDF weights are column and row operations.
+
+class LabelLemmaMatrix:
+    #a scipy.sparse CSR matrix of counts with a row for each label and a column for each lemma (indexed by the labels
+    #and lemmas Vocabularies).  Occurrences are buffered as (label, lemma, count) and folded into the matrix when it is
+    #read or the buffer is full
+    
+    BUFFER=1<<20
+    
+    def __init__(self):
+        self.labels=Vocabulary()
+        self.lemmas=Vocabulary()
+        self.counts=sparse.csr_matrix((0,0),dtype=np.int64)
+        self.clear_buffer()
+        
+    def clear_buffer(self):
+        self.rows=array('q')
+        self.cols=array('q')
+        self.values=array('q')
+        
+    def add(self,label,lemma,count=1):
+        self.rows.append(self.labels.intern(label))
+        self.cols.append(self.lemmas.intern(lemma))
+        self.values.append(count)
+        if len(self.values)>=LabelLemmaMatrix.BUFFER:
+            self.fold()
+            
+    def add_matrix(self,other,sign=1):
+        #add (or with sign=-1 subtract) the counts of another LabelLemmaMatrix, whose indexes may differ from these
+        counts=other.matrix.tocoo()
+        rowids=np.array([self.labels.intern(label) for label in other.labels.strings],dtype=np.int64)
+        colids=np.array([self.lemmas.intern(lemma) for lemma in other.lemmas.strings],dtype=np.int64)
+        self.fold()
+        self.counts=self.resized()+sparse.csr_matrix((sign*counts.data,(rowids[counts.row],colids[counts.col])),shape=self.shape())
+        self.counts.eliminate_zeros()
+        
+    def shape(self):
+        return (len(self.labels),len(self.lemmas))
+    
+    def resized(self):
+        counts=self.counts
+        if counts.shape!=self.shape():
+            counts=counts.copy()
+            counts.resize(self.shape())
+        return counts
+    
+    def fold(self):
+        if len(self.values)==0 and self.counts.shape==self.shape():
+            return
+        added=sparse.csr_matrix((np.frombuffer(self.values,dtype=np.int64),(np.frombuffer(self.rows,dtype=np.int64),np.frombuffer(self.cols,dtype=np.int64))),shape=self.shape())
+        self.counts=self.resized()+added
+        self.counts.eliminate_zeros()
+        self.clear_buffer()
+        
+    @property
+    def matrix(self):
+        self.fold()
+        return self.counts
+    
+    def copy(self):
+        result=LabelLemmaMatrix()
+        result.add_matrix(self)
+        return result
+    
+    def docfreq_array(self):
+        #the number of labels each lemma occurs with, in lemma index order
+        return self.matrix.getnnz(axis=0)
+    
+    def docfreq(self):
+        #lemma -> number of labels, for the lemmas which occur
+        return {lemma:df for (lemma,df) in zip(self.lemmas.strings,self.docfreq_array().tolist()) if df>0}
+    
+    def label_frequencies(self,label):
+        #lemma -> count for one label
+        if label not in self.labels.ids:
+            return {}
+        row=self.matrix.getrow(self.labels.ids[label])
+        return {self.lemmas.strings[j]:int(value) for (j,value) in zip(row.indices,row.data)}
+    
+    def tfidf(self):
+        #counts weighted by log(number of labels / document frequency) of each lemma, as a CSR matrix
+        df=self.docfreq_array()
+        idf=np.log(self.matrix.shape[0]/np.maximum(df,1))
+        return sparse.csr_matrix(self.matrix.multiply(idf[np.newaxis,:]))
+    
+    def to_dict(self):
+        #lemma -> {label: count}
+        counts=self.matrix.tocoo()
+        result=defaultdict(Counter)
+        for (i,j,value) in zip(counts.row.tolist(),counts.col.tolist(),counts.data.tolist()):
+            result[self.lemmas.strings[j]][self.labels.strings[i]]=value
+        return result
+    
+    @classmethod
+    def from_dict(cls,data):
+        result=cls()
+        for (lemma,labels) in data.items():
+            for (label,count) in labels.items():
+                result.add(label,lemma,count)
+        result.fold()
+        return result
+
+
+# Corpus statistics as a value: the counts, totals and length histograms of a corpus can be added together (to combine corpora, or the shards of a large input analysed separately) and subtracted (to remove a part) without analysing anything again.
+
+class CorpusStats:
+    
+    countdicts=['allworddict','worddict','noundict','propnoundict','verbdict','adjdict','advdict','wordposdict','wordlengths','sentencelengths','doclengths']
+    totals=['wordtotal','nountotal','propnountotal','verbtotal','adjtotal','advtotal','count']
+    
+    def __init__(self,source=None):
+        #a copy of the statistics of source (a corpus or CorpusStats), or empty statistics
+        for name in self.countdicts:
+            setattr(self,name,defaultdict(int) if source is None else defaultdict(int,getattr(source,name)))
+        for name in self.totals:
+            setattr(self,name,0 if source is None else getattr(source,name))
+        #in paired mode the number of occurrences of each lemma with each label, so that document frequencies can be merged
+        self.doctermmatrix=LabelLemmaMatrix() if source is None else source.doctermmatrix.copy()
+                
+    @property
+    def docfreq(self):
+        return self.doctermmatrix.docfreq()
+            
+    def combine(self,other,sign):
+        result=type(self)(self)
+        for name in self.countdicts:
+            counts=getattr(result,name)
+            for (key,value) in getattr(other,name).items():
+                value=counts.get(key,0)+sign*value
+                if value==0:
+                    counts.pop(key,None)
+                else:
+                    counts[key]=value
+        for name in self.totals:
+            setattr(result,name,getattr(self,name)+sign*getattr(other,name))
+        result.doctermmatrix.add_matrix(other.doctermmatrix,sign)
+        return result
+    
+    def __add__(self,other):
+        return self.combine(other,1)
+    
+    def __radd__(self,other):
+        #so that sum() works on a list of statistics
+        if other==0:
+            return type(self)(self)
+        return NotImplemented
+    
+    def __sub__(self,other):
+        return self.combine(other,-1)
+    
+    def __eq__(self,other):
+        if not isinstance(other,CorpusStats):
+            return NotImplemented
+        return all(dict(getattr(self,name))==dict(getattr(other,name)) for name in self.countdicts) and \
+            all(getattr(self,name)==getattr(other,name) for name in self.totals) and \
+            self.doctermmatrix.to_dict()==other.doctermmatrix.to_dict()
+    
+    def get_word_distribution(self,wordtype):
+        
+        if wordtype=="NOUN":
+            return(self.noundict,self.nountotal)
+        elif wordtype=="VERB":
+            return(self.verbdict,self.verbtotal)
+        elif wordtype=="ADJ":
+            return(self.adjdict,self.adjtotal)
+        elif wordtype=="ADV":
+            return(self.advdict,self.advtotal)
+        else:
+            return(self.worddict,self.wordtotal)
+        
+    def to_json(self):
+        #keys may be tuples (wordposdict) or ints (the histograms) so the dictionaries are written as [key,value] pairs
+        data={name:[[key,value] for (key,value) in getattr(self,name).items()] for name in self.countdicts}
+        data.update({name:getattr(self,name) for name in self.totals})
+        data['worddocdict']=self.doctermmatrix.to_dict()
+        return data
+    
+    @classmethod
+    def from_json(cls,data):
+        stats=cls()
+        for name in cls.countdicts:
+            setattr(stats,name,defaultdict(int,((tuple(key) if isinstance(key,list) else key,value) for (key,value) in data[name])))
+        for name in cls.totals:
+            setattr(stats,name,data[name])
+        stats.doctermmatrix=LabelLemmaMatrix.from_dict(data['worddocdict'])
+        return stats
+    
+    def save(self,path):
+        with open(path,'w') as outstream:
+            json.dump(self.to_json(),outstream)
+            
+    @classmethod
+    def load(cls,path):
+        with open(path) as instream:
+            return cls.from_json(json.load(instream))
+        
+
+_shard={}
+
+
+def _init_shard(nlpmodel,options):
+    _shard['nlp']=nlpmodel
+    _shard['options']=options
+    
+    
+def _analyse_shard(shard):
+    return CorpusStats(corpus(shard,_shard['nlp'],**_shard['options']))
+
+
+def analyse_shards(shards,nlpmodel,workers=1,**options):
+    #analyse each shard (the ipfiles of a corpus: a list of source files, or of documents with loadfiles=False) as a
+    #separate corpus and add up their statistics, in a pool of processes if workers>1.  options are passed to corpus,
+    #with prop=100 unless given.  Statistics of shards analysed elsewhere can be written with CorpusStats.save
+    #and added to these after CorpusStats.load
+    options.setdefault('prop',100)
+    if workers<=1:
+        parts=[CorpusStats(corpus(shard,nlpmodel,**options)) for shard in shards]
+    else:
+        with Pool(workers,initializer=_init_shard,initargs=(nlpmodel,options)) as pool:
+            parts=pool.map(_analyse_shard,shards)
+    return sum(parts,CorpusStats())
+
+
 def summarise(freqtable_dict):
     
     sumf=0
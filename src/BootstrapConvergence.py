@@ -0,0 +1,143 @@
+import numpy as np
+import logging
+import heapq
+import math
+from statistics import NormalDist
+
+# Incremental convergence tracking for bootstrap repetitions, an alternative to check_convergence.
+# The tracker is fed the indicator counts of every repetition (BootstrapParallel.run_repetitions calls update),
+# so only the terms whose counts changed are touched, and the terms in order of count are kept in a heap.
+# At each check, every term's indicator proportion gets a Wilson confidence interval and the run stops once
+# each interval either excludes the threshold or is narrower than the margin.
+# The margin trades repetitions for precision: for a term whose proportion is close to the threshold, an interval
+# of half-width m takes about z^2 * t(1-t) / m^2 repetitions, e.g. some 1500 for m=0.02 at t=0.9 and 99% confidence,
+# far more than the usual 250.  So by default the margin is the half-width which every term within the margin of the
+# threshold reaches after repeats repetitions (the widest being the one furthest towards 1/2): the run stops early
+# once no term would be pinned down much better by finishing it, which happens before repeats only when no term sits
+# right at the threshold.  With repeats=250 that is a margin of about 0.06 at t=0.9 and 99% confidence.
+
+
+class ConvergenceTracker:
+
+    def __init__(self, outfile_stem=None, threshold=0.9, confidence=0.99, margin=None, repeats=250, min_repeats=0, vocab=None):
+        #vocab names the positions of array indicator counts (e.g. CountMatrix.vocab); dict counts name themselves.
+        #margin None derives the margin from repeats, the number of repetitions planned (see above)
+        self.outfile_stem = outfile_stem
+        self.threshold = threshold
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        if margin is None:
+            margin = float(self.half_width(threshold, repeats))
+            for _ in range(20):
+                margin = float(self.half_width(threshold - math.copysign(margin, threshold - 0.5), repeats))
+        self.margin = margin
+        self.min_repeats = min_repeats
+        self.vocab = vocab
+        self.ids = {}
+        self.terms = []
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.size = 0
+        self.heap = []
+        self.N = 0
+        self.projected = None
+
+    def grow(self, size):
+        self.size = max(self.size, size)
+        if size > len(self.counts):
+            counts = np.zeros(max(size, 2 * len(self.counts)), dtype=np.int64)
+            counts[:len(self.counts)] = self.counts
+            self.counts = counts
+
+    def update(self, partial):
+        #add the indicator counts of one repetition
+        self.N += 1
+        if isinstance(partial, dict):
+            changed = []
+            for (term, value) in partial.items():
+                if value != 0:
+                    i = self.ids.get(term)
+                    if i is None:
+                        i = len(self.terms)
+                        self.ids[term] = i
+                        self.terms.append(term)
+                    changed.append((i, value))
+            self.grow(len(self.terms))
+            for (i, value) in changed:
+                self.counts[i] += value
+                heapq.heappush(self.heap, (-int(self.counts[i]), int(i)))
+        else:
+            self.grow(len(partial))
+            self.counts[:len(partial)] += partial
+            for i in np.flatnonzero(partial):
+                heapq.heappush(self.heap, (-int(self.counts[i]), int(i)))
+        if len(self.heap) > 4 * len(self.counts) + 1000:
+            #drop the stale entries
+            self.heap = [(-int(self.counts[i]), int(i)) for i in np.flatnonzero(self.counts)]
+            heapq.heapify(self.heap)
+
+    def resync(self, indicators, N):
+        #rebuild from totals, for when update has not been called for every repetition
+        self.ids = {}
+        self.terms = []
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.size = 0
+        self.heap = []
+        self.N = N - 1
+        self.update(indicators)
+
+    def name(self, i):
+        if self.vocab is not None:
+            return self.vocab[i]
+        return self.terms[i]
+
+    def top(self, minscore=0.505):
+        #(term, score) pairs with score at least minscore, best first, taken from the heap without a full sort
+        found = []
+        seen = set()
+        while self.heap:
+            (negcount, i) = self.heap[0]
+            if -negcount != self.counts[i] or i in seen:
+                heapq.heappop(self.heap)
+                continue
+            if (-negcount + 1) / (self.N + 1) < minscore:
+                break
+            heapq.heappop(self.heap)
+            seen.add(i)
+            found.append((negcount, i))
+        for entry in found:
+            heapq.heappush(self.heap, entry)
+        return [(self.name(i), (-negcount + 1) / (self.N + 1)) for (negcount, i) in found]
+
+    def half_width(self, p, N):
+        #half-width of the Wilson score interval of a proportion p over N repetitions
+        z2 = self.z * self.z
+        return self.z * np.sqrt(p * (1 - p) / N + z2 / (4 * N * N)) / (1 + z2 / N)
+
+    def bounds(self):
+        #Wilson score interval for the indicator proportion of every term seen so far
+        N = self.N
+        p = self.counts[:self.size] / N
+        z2 = self.z * self.z
+        centre = (p + z2 / (2 * N)) / (1 + z2 / N)
+        half = self.half_width(p, N)
+        return p, centre - half, centre + half
+
+    def __call__(self, indicators, N):
+        if N != self.N:
+            self.resync(indicators, N)
+        if self.outfile_stem is not None:
+            with open(self.outfile_stem + "_" + str(N), "w") as outstream:
+                for (term, score) in self.top():
+                    outstream.write("{}\t{}\n".format(term, score))
+
+        p, lower, upper = self.bounds()
+        decided = (upper < self.threshold) | (lower > self.threshold) | ((upper - lower) / 2 <= self.margin)
+        undecided = np.flatnonzero(~decided)
+        if len(undecided) > 0:
+            pu = p[undecided]
+            distance = np.maximum(np.abs(pu - self.threshold), self.margin)
+            needed = self.z * self.z * np.maximum(pu * (1 - pu), 1 / N) / (distance * distance)
+            self.projected = max(int(math.ceil(needed.max())) - N, 0)
+        else:
+            self.projected = 0
+        logging.info("{} of {} terms undecided at {} repetitions, projected {} more".format(len(undecided), len(p), N, self.projected))
+        return N >= self.min_repeats and len(undecided) == 0
@@ -1,35 +1,89 @@
 import pandas as pd
 import numpy as np
+from scipy import sparse
 import matplotlib as plt
-from collections import defaultdict
+from collections import defaultdict,Counter
 import random
 import nlp_tools
+import BootstrapParallel as bp
+import BootstrapConvergence
+from multiprocessing import Pool
+import obv_cache
 import spacy,operator
 import logging
-import configparser,ast,os,sys
-from time import time
+import configparser,ast,os,sys,re,weakref
 
 
-def make_countdict(alldata):
-    countdict = {}
+class ValueCatalogue:
+    #the values occurring in each (non-blacklisted) column of a frame and their counts, built with one
+    #value_counts per column.  Behaves like the dict of dicts make_countdict used to return, so it can be
+    #passed straight to validated, and also answers existence, count and min/max queries
     blacklist = ['words', 'obc_hiscoCode']
 
-    for heading in alldata.columns:
-        # print('Generating counts for ' +heading)
-        if heading not in blacklist:
-            countdict[heading] = defaultdict(int)
-            selection = alldata[heading]
-            for item in selection:
-                # print(item)
-                countdict[heading][item] += 1
-        else:
-            # print('skipping')
-            pass
+    def __init__(self, frame):
+        self.counts = {}
+        self.ranges = {}
+        for heading in frame.columns:
+            if heading not in ValueCatalogue.blacklist:
+                column = frame[heading]
+                #categorical columns also count their unused categories (with 0), which are not values of the frame
+                counts = column.value_counts(dropna=False)
+                self.counts[heading] = counts[counts > 0].to_dict()
+                if pd.api.types.is_numeric_dtype(column) and column.notna().any():
+                    self.ranges[heading] = (column.min(), column.max())
+
+    def __contains__(self, heading):
+        return heading in self.counts
+
+    def __getitem__(self, heading):
+        return self.counts[heading]
+
+    def keys(self):
+        return self.counts.keys()
+
+    def items(self):
+        return self.counts.items()
+
+    def exists(self, heading, value):
+        return heading in self.counts and value in self.counts[heading]
+
+    def count(self, heading, value):
+        return self.counts.get(heading, {}).get(value, 0)
+
+    def values(self, heading):
+        return list(self.counts.get(heading, {}).keys())
+
+    def min(self, heading):
+        return self.ranges[heading][0]
+
+    def max(self, heading):
+        return self.ranges[heading][1]
 
-    return countdict
 
+_catalogues = {}
 
-def validated(reqlist, valuedata):
+
+def value_catalogue(frame):
+    #ValueCatalogue of a frame, memoised against the frame's identity (frames are treated as immutable)
+    key = id(frame)
+    entry = _catalogues.get(key)
+    if entry is not None and entry[0]() is frame:
+        return entry[1]
+
+    def forget(ref, key=key):
+        if _catalogues.get(key, (None,))[0] is ref:
+            del _catalogues[key]
+
+    catalogue = ValueCatalogue(frame)
+    _catalogues[key] = (weakref.ref(frame, forget), catalogue)
+    return catalogue
+
+
+def make_countdict(alldata):
+    return value_catalogue(alldata)
+
+
+def validated(reqlist, valuedata, columns=()):
     reqdict = {}
     for (field, value) in reqlist:
 
@@ -49,7 +103,11 @@ def validated(reqlist, valuedata):
 
         else:
             if parts[1]=="not" and parts[0] in valuedata.keys():
-                if value in valuedata[parts[0]].keys():
+                if isinstance(value, list):
+                    ok = [v for v in value if v in valuedata[parts[0]].keys()]
+                    if len(ok) > 0:
+                        reqdict[field] = ok
+                elif value in valuedata[parts[0]].keys():
                     reqdict[field] = value
 
             elif (parts[1] == "max" or parts[1] == "min") and parts[0] in valuedata.keys():
@@ -60,47 +118,143 @@ def validated(reqlist, valuedata):
                 elif value in valuedata[parts[0]].keys() and isinstance(value, int):
                     reqdict[field] = value
 
+            elif parts[1] == "range" and parts[0] in valuedata.keys():
+                #inclusive (min, max) pair - unlike min and max the bounds need not occur in the data
+                if isinstance(value, (list, tuple)) and len(value) == 2 and all(isinstance(v, int) for v in value):
+                    reqdict[field] = tuple(value)
+                else:
+                    logging.warning("Error: range must be a pair of ints")
+
+            elif parts[1] == "regex" and parts[0] in columns:
+                #regex requirements may also apply to columns without a value count e.g., words
+                try:
+                    re.compile(value)
+                    reqdict[field] = value
+                except (re.error, TypeError):
+                    logging.warning("Error: invalid regex {}".format(value))
+
     return reqdict
 
 
+class RequirementQuery:
+    #a requirement list such as [('year:min', 1800), ('obv_role', ['def','wv'])] compiled against a frame once.
+    #Requirements are validated per frame and the combined boolean mask of each frame is cached, so repeated
+    #sampling calls (and slices of an indexed frame, see TrialIndex.get) reuse it instead of re-filtering
+    #supported forms are field, field:not, field:min, field:max, field:range (inclusive pair) and field:regex
+
+    def __init__(self, reqlist):
+        self.reqlist = list(reqlist)
+        self.reqdicts = {}
+        self.masks = {}
+
+    def __iter__(self):
+        return iter(self.reqlist)
+
+    def reqdict(self, frame):
+        #the requirements which are valid for this frame (see validated)
+        key = id(frame)
+        if key not in self.reqdicts:
+            self.reqdicts[key] = (frame, validated(self.reqlist, value_catalogue(frame), columns=frame.columns))
+        return self.reqdicts[key][1]
+
+    def unsatisfied(self, *frames):
+        #requirements which are not valid for any of the frames
+        reqdicts = [self.reqdict(frame) for frame in frames]
+        return [req for (req, _value) in self.reqlist if not any(req in reqdict for reqdict in reqdicts)]
+
+    def mask(self, frame):
+        #boolean array selecting the rows of frame which meet every valid requirement, evaluated in one pass
+        key = id(frame)
+        if key not in self.masks:
+            mask = np.ones(len(frame), dtype=bool)
+            for (req, value) in self.reqdict(frame).items():
+                mask &= condition(frame, req, value)
+            self.masks[key] = (frame, mask)
+        return self.masks[key][1]
+
+    def select(self, frame):
+        return frame[self.mask(frame)]
+
+
+def compile_requirements(reqs):
+    if isinstance(reqs, RequirementQuery):
+        return reqs
+    return RequirementQuery(reqs)
+
+
+def condition(frame, req, value):
+    #boolean array for a single validated requirement
+    parts = req.split(':')
+    column = frame[parts[0]]
+    if len(parts) > 1:
+        if parts[1] == 'not':
+            if isinstance(value, list):
+                return ~column.isin(value).values
+            return (column != value).values
+        elif parts[1] == 'max':
+            return (column <= value).values
+        elif parts[1] == 'min':
+            return (column >= value).values
+        elif parts[1] == 'range':
+            return ((column >= value[0]) & (column <= value[1])).values
+        elif parts[1] == 'regex':
+            return column.astype(str).str.contains(value, regex=True).values
+    elif isinstance(value, list):
+        return column.isin(value).values
+    return (column == value).values
+
+
 def find_trials(worddf, trialdf,reqlist, join='obo_trial'):
-    trialreqdict = validated(reqlist, make_countdict(trialdf))
-    wordsreqdict = validated(reqlist, make_countdict(worddf))
+    #reqlist is a list of requirements or a RequirementQuery
+    query = compile_requirements(reqlist)
 
-    logging.info(trialreqdict)
-    logging.info(wordsreqdict)
+    logging.info(query.reqdict(trialdf))
+    logging.info(query.reqdict(worddf))
     ok = True
-    for (req, _value) in reqlist:
-        if req in trialreqdict.keys() or req in wordsreqdict.keys():
-            pass
-        else:
-            logging.warning("Requirement {} not satisfied".format(req))
-            ok = False
+    for req in query.unsatisfied(trialdf, worddf):
+        logging.warning("Requirement {} not satisfied".format(req))
+        ok = False
 
     if not ok:
         return None
 
-    trials = trialdf
-    for req in trialreqdict.keys():
-        parts = req.split(':')
-        value = trialreqdict[req]
-        if len(parts)>1:
-            if parts[1]=='not':
-                trials=trials[trials[parts[0]]!=value]
-            elif parts[1]=='max':
-                trials=trials[trials[parts[0]]<=value]
-            elif parts[1]=='min':
-                trials=trials[trials[parts[0]]>=value]
-        elif isinstance(value,list):
-            trials=trials[trials[req].isin(value)]
-        else:
-            trials=trials[trials[req]==value]
-
+    trials = query.select(trialdf)
 
     selection=[line for line in trials[join]]
     return selection
 
 
+class TrialIndex:
+    #index of the words frame by trial: the frame is sorted once (stable, so utterances keep their order)
+    #and the start and end offsets of each trial's block are stored, so a trial is a slice rather than a scan
+
+    def __init__(self, worddata, join='obo_trial'):
+        self.join=join
+        self.data=worddata.sort_values(join, kind='mergesort')
+        keys=self.data[join].values
+        self.offsets={}
+        if len(keys)>0:
+            starts=np.flatnonzero(np.r_[True, keys[1:]!=keys[:-1]])
+            ends=np.r_[starts[1:], len(keys)]
+            for key, start, end in zip(keys[starts], starts, ends):
+                self.offsets[key]=(start, end)
+        logging.info("Indexed {} rows for {} trials".format(len(keys), len(self.offsets)))
+
+    def __contains__(self, trial):
+        return trial in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get(self, trial, query=None):
+        #all rows of the words frame for the given trial (empty frame if the trial is unknown)
+        #if a RequirementQuery is given, only those rows meeting it - its mask over the whole frame is sliced
+        (start, end)=self.offsets.get(trial, (0, 0))
+        if query is None:
+            return self.data.iloc[start:end]
+        return self.data.iloc[start:end][query.mask(self.data)[start:end]]
+
+
 def bootstrap1(wdf, tdf, reqs):
     trials = find_trials(wdf, tdf, reqs)
     # print(len(trials),trials)
@@ -108,31 +262,19 @@ def bootstrap1(wdf, tdf, reqs):
     print(c)
 
 
-def bootstrap_corpus(worddata, trials, reqs,prop=100,size=0):
+def bootstrap_corpus(worddata, trials, reqs,prop=100,size=0,index=None,rng=random):
+    if index is None:
+        index=TrialIndex(worddata)
     N = len(trials)
     corpus = []
     N=int(N*prop/100)
-    allreqdict = validated(reqs, make_countdict(worddata))
+    query = compile_requirements(reqs)
     i=0
     cont=True
     while cont:
         i+=1
-        atrial = random.choice(trials)
-        wdf = worddata[worddata['obo_trial'] == atrial]
-        for req in allreqdict.keys():
-            parts = req.split(':')
-            value = allreqdict[req]
-            if len(parts) > 1:
-                if parts[1]=='not':
-                    wdf=wdf[wdf[parts[0]]!=value]
-                elif parts[1] == 'max':
-                    wdf = wdf[wdf[parts[0]] <= value]
-                elif parts[1] == 'min':
-                    wdf = wdf[wdf[parts[0]] >= value]
-            elif isinstance(value, list):
-                wdf = wdf[wdf[req].isin(value)]
-            else:
-                wdf = wdf[wdf[req] == value]
+        atrial = rng.choice(trials)
+        wdf = index.get(atrial, query)
 
         corpus += [line for line in wdf['words']]
         if i>N or(size>0 and len(corpus)>=size):  #under-sample so corpus is not bigger than specified size, no over-sampling
@@ -140,28 +282,16 @@ def bootstrap_corpus(worddata, trials, reqs,prop=100,size=0):
 
     return corpus
 
-def generate_corpus(worddata, trials, reqs,prop=100,size=0):
+def generate_corpus(worddata, trials, reqs,prop=100,size=0,index=None):
+    if index is None:
+        index=TrialIndex(worddata)
     N = len(trials)
     corpus = []
     N=int(N*prop/100)
-    allreqdict = validated(reqs, make_countdict(worddata))
+    query = compile_requirements(reqs)
 
     for i,atrial in enumerate(trials):
-        wdf = worddata[worddata['obo_trial'] == atrial]
-        for req in allreqdict.keys():
-            parts = req.split(':')
-            value = allreqdict[req]
-            if len(parts) > 1:
-                if parts[1]=='not':
-                    wdf=wdf[wdf[parts[0]]!=value]
-                elif parts[1] == 'max':
-                    wdf = wdf[wdf[parts[0]] <= value]
-                elif parts[1] == 'min':
-                    wdf = wdf[wdf[parts[0]] >= value]
-            elif isinstance(value, list):
-                wdf = wdf[wdf[req].isin(value)]
-            else:
-                wdf = wdf[wdf[req] == value]
+        wdf = index.get(atrial, query)
 
         corpus += [line for line in wdf['words']]
 
@@ -173,6 +303,103 @@ def generate_corpus(worddata, trials, reqs,prop=100,size=0):
     return corpus
 
 
+class CountMatrix:
+    #each distinct utterance is analysed once into a row of a sparse utterance x term count matrix
+    #(lower-cased token counts, as in nlp_tools.corpus.allworddict).  A corpus is then a vector of
+    #utterance weights and its word counts are the weights times the matrix
+
+    def __init__(self, nlpmodel):
+        self.nlp=nlpmodel
+        self.rows={}
+        self.terms={}
+        self.vocab=[]
+        self.data=[]
+        self.indices=[]
+        self.indptr=[0]
+        self.matrix=None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, utterances):
+        #return the row of each utterance, analysing only the ones not seen before
+        rowids=[]
+        for utterance in utterances:
+            row=self.rows.get(utterance)
+            if row is None:
+                row=len(self.rows)
+                self.rows[utterance]=row
+                counts=defaultdict(int)
+                for token in self.nlp(utterance):
+                    counts[token.text.lower()]+=1
+                for (term, count) in counts.items():
+                    col=self.terms.get(term)
+                    if col is None:
+                        col=len(self.vocab)
+                        self.terms[term]=col
+                        self.vocab.append(term)
+                    self.indices.append(col)
+                    self.data.append(count)
+                self.indptr.append(len(self.indices))
+                self.matrix=None
+            rowids.append(row)
+        return np.array(rowids, dtype=np.int64)
+
+    def get_matrix(self):
+        if self.matrix is None:
+            self.matrix=sparse.csr_matrix((np.array(self.data, dtype=np.int64), np.array(self.indices, dtype=np.int64),
+                                           np.array(self.indptr, dtype=np.int64)), shape=(len(self.rows), len(self.vocab)))
+        return self.matrix
+
+    def weights(self, rowids):
+        #utterance weight vector for a corpus given as (possibly repeated) row ids
+        return np.bincount(rowids, minlength=len(self.rows))
+
+    def counts(self, weights):
+        #word counts of the corpus with the given utterance weights
+        return self.get_matrix().T.dot(weights)
+
+    def to_dict(self, values):
+        return {self.vocab[col]: int(values[col]) for col in np.flatnonzero(values)}
+
+
+def trial_rows(countmatrix, worddata, trials, reqs, index=None):
+    #rows of the count matrix for the utterances of each trial which meet the requirements
+    if index is None:
+        index=TrialIndex(worddata)
+    query = compile_requirements(reqs)
+    rowdict = {}
+    for atrial in set(trials):
+        wdf = index.get(atrial, query)
+        rowdict[atrial] = countmatrix.add([line for line in wdf['words']])
+    return rowdict
+
+
+def bootstrap_rows(rowdict, trials, prop=100, size=0, rng=random):
+    #draw trials as bootstrap_corpus does and return the row ids of the sampled utterances
+    N = int(len(trials)*prop/100)
+    chosen = []
+    total = 0
+    i=0
+    cont=True
+    while cont:
+        i+=1
+        rows = rowdict[rng.choice(trials)]
+        chosen.append(rows)
+        total += len(rows)
+        if i>N or(size>0 and total>=size):
+            cont=False
+    return np.concatenate(chosen)
+
+
+def compare_counts(countsA, countsB, indicators):
+    #array version of compare(): add one to the indicator of every term more probable in A than in B
+    sizeA = countsA.sum()
+    sizeB = countsB.sum()
+    indicators += (countsA > 0) & (countsA / sizeA > countsB / sizeB)
+    return indicators
+
+
 
 # For a given set of corpora, find the frequency distribution of the k highest frequency words
 # Output total size of corpus and sorted list of term, frequency pairs
@@ -182,12 +409,12 @@ def find_hfw_dist(corpora, k=100000):
     # sort and output highest frequency words
     # visualise
 
-    sumdict = {}
+    #corpora may be corpora or their (merged) nlp_tools.CorpusStats.  allworddict keys are already lower case
+    sumdict = Counter()
     corpussize = 0
     for acorpus in corpora:
-        for (key, value) in acorpus.allworddict.items():
-            sumdict[key.lower()] = sumdict.get(key.lower(), 0) + value
-            corpussize += value
+        sumdict.update(acorpus.allworddict)
+        corpussize += sum(acorpus.allworddict.values())
 
     logging.info("Size of corpus is {}".format(corpussize))
     candidates = sorted(sumdict.items(), key=operator.itemgetter(1), reverse=True)
@@ -252,45 +479,336 @@ def check_convergence(newdict,cache,outfile,N,t=0.9):
 
 
 
-def bootstrap_compare(corpusAreqs, allreqs, worddata, trialdata, repeats=10, prop=100,interval=100,outfile_stem="words"):
-    logging.info("Finding trials to meet requirements")
-    trialsB = find_trials(worddata, trialdata, allreqs + negate(corpusAreqs))
-    logging.info(len(trialsB))
-    trialsA = find_trials(worddata, trialdata, allreqs + corpusAreqs)
-    logging.info(len(trialsA))
-    indicatordict = {}
+def convergence_check(outfile_stem, todict=None):
+    #check function for BootstrapParallel.run_repetitions which keeps the previous check_convergence cache
+    cacheddict = {}
 
-    logging.info("Generating corpusB")
-    corpB = generate_corpus(worddata, trialsB, allreqs + negate(corpusAreqs),prop=prop)
-    logging.info("Analysing corpus")
-    corpusB = nlp_tools.corpus(corpB, nlp, prop=100, ner=False, loadfiles=False)
-    cacheddict={}
-    N=repeats
-    for j in range(0, repeats):
+    def check(indicators, N):
+        nonlocal cacheddict
+        if todict is not None:
+            indicators = todict(indicators)
+        cacheddict, stop = check_convergence(indicators, cacheddict, outfile_stem + "_" + str(N), N)
+        return stop
+
+    return check
 
-        starttime=time()
-        logging.info("Bootstrapping corpusA repetition {}".format(j))
-        #make the size of corpA the same as the size of corpB i.e., over or under sample accordingly
-        corpA = bootstrap_corpus(worddata, trialsA, allreqs + corpusAreqs,prop=prop,size=len(corpB))
 
+def corpus_repetition(worddata, trialsA, reqsA, corpusB, prop, size, index, cache, rng=random):
+    #one repetition of bootstrap_compare: the indicator counts of a freshly drawn and analysed corpus A
+    #make the size of corpA the same as the size of corpB i.e., over or under sample accordingly
+    corpA = bootstrap_corpus(worddata, trialsA, reqsA, prop=prop, size=size, index=index, rng=rng)
+    logging.info("Analysing corpus")
+    corpusA = nlp_tools.corpus(corpA, nlp, prop=100, ner=False, loadfiles=False, cache=cache)
+    logging.info("Comparing corpora")
+    return compare(corpusA, corpusB, {})
+
+
+def matrix_repetition(countmatrix, rowdictA, trialsA, countsB, prop, size, rng=random):
+    #one repetition of bootstrap_compare_matrix
+    rowsA = bootstrap_rows(rowdictA, trialsA, prop=prop, size=size, rng=rng)
+    indicators = np.zeros(len(countmatrix.vocab), dtype=np.int64)
+    return compare_counts(countmatrix.counts(countmatrix.weights(rowsA)), countsB, indicators)
+
+
+def bootstrap_compare(corpusAreqs, allreqs, worddata, trialdata, repeats=10, prop=100,interval=100,outfile_stem="words",index=None,cache=None,workers=1,seed=None,shared=None,tracker=None):
+    #tracker is an optional BootstrapConvergence.ConvergenceTracker used instead of check_convergence
+    #shared is an optional dict in which corpus B is kept for reuse by later calls with the same B requirements
+    #workers > 1 runs the repetitions in a process pool; with a seed the result is the same for any number of workers
+    #index is a TrialIndex over worddata, shared by every repetition (built here if not supplied)
+    #cache is an optional nlp_tools.AnalysisCache so that utterances are only parsed the first time they are drawn
+    if index is None:
+        index=TrialIndex(worddata)
+    #each requirement list is compiled once and its masks are shared by every sampling call
+    queryA = RequirementQuery(allreqs + corpusAreqs)
+    queryB = RequirementQuery(allreqs + negate(corpusAreqs))
+    logging.info("Finding trials to meet requirements")
+    trialsA = find_trials(index.data, trialdata, queryA)
+    logging.info(len(trialsA))
+
+    keyB = (repr(queryB.reqlist), prop)
+    if shared is not None and keyB in shared:
+        logging.info("Reusing corpusB")
+        (corpB, corpusB) = shared[keyB]
+    else:
+        trialsB = find_trials(index.data, trialdata, queryB)
+        logging.info(len(trialsB))
+        logging.info("Generating corpusB")
+        corpB = generate_corpus(index.data, trialsB, queryB,prop=prop,index=index)
         logging.info("Analysing corpus")
-        corpusA = nlp_tools.corpus(corpA, nlp, prop=100, ner=False, loadfiles=False)
-        logging.info("Comparing corpora")
-        timetaken=time()-starttime
-        logging.info("Time taken for this iteration: {}".format(timetaken))
-        indicatordict = compare(corpusA, corpusB, indicatordict)
-        if (j+1)%interval==0:
-            cacheddict,stop=check_convergence(indicatordict,cacheddict,outfile_stem+"_"+str(j+1),j+1)
-
-            if stop:
-                N=j+1
-                break
+        corpusB = nlp_tools.corpus(corpB, nlp, prop=100, ner=False, loadfiles=False, cache=cache)
+        if shared is not None:
+            shared[keyB] = (corpB, corpusB)
+    check = tracker if tracker is not None else convergence_check(outfile_stem)
+    #the analysis cache holds an sqlite connection which cannot be shared with forked workers
+    args = (index.data, trialsA, queryA, corpusB, prop, len(corpB), index, cache if workers <= 1 else None)
+    indicatordict, N = bp.run_repetitions(corpus_repetition, args, {}, repeats, interval, check, workers=workers, seed=seed)
 
     logging.info("Generating candidates")
     candidates = [(term, (value + 1) / (N + 1)) for (term, value) in indicatordict.items()]
     sortedlist = sorted(candidates, key=operator.itemgetter(1), reverse=True)
     return sortedlist
 
+def bootstrap_compare_matrix(corpusAreqs, allreqs, worddata, trialdata, repeats=10, prop=100,interval=100,outfile_stem="words",index=None,countmatrix=None,workers=1,seed=None,shared=None,tracker=None):
+    #same experiment as bootstrap_compare, but every utterance is analysed only once into countmatrix
+    #and each repetition is a resampled weight vector times the count matrix
+    if index is None:
+        index=TrialIndex(worddata)
+    if countmatrix is None:
+        countmatrix=CountMatrix(nlp)
+    #each requirement list is compiled once and its masks are shared by every sampling call
+    queryA = RequirementQuery(allreqs + corpusAreqs)
+    queryB = RequirementQuery(allreqs + negate(corpusAreqs))
+    logging.info("Finding trials to meet requirements")
+    trialsA = find_trials(index.data, trialdata, queryA)
+    logging.info(len(trialsA))
+
+    keyB = (repr(queryB.reqlist), prop)
+    if shared is not None and keyB in shared:
+        logging.info("Reusing corpusB")
+        (corpB, rowsB) = shared[keyB]
+    else:
+        trialsB = find_trials(index.data, trialdata, queryB)
+        logging.info(len(trialsB))
+        logging.info("Generating corpusB")
+        corpB = generate_corpus(index.data, trialsB, queryB,prop=prop,index=index)
+        logging.info("Analysing utterances")
+        rowsB = countmatrix.add(corpB)
+        if shared is not None:
+            shared[keyB] = (corpB, rowsB)
+    rowdictA = trial_rows(countmatrix, index.data, trialsA, queryA, index=index)
+    logging.info("Count matrix has {} utterances and {} terms".format(len(countmatrix), len(countmatrix.vocab)))
+    countsB = countmatrix.counts(countmatrix.weights(rowsB))
+    if tracker is not None:
+        tracker.vocab = countmatrix.vocab
+        check = tracker
+    else:
+        check = convergence_check(outfile_stem, todict=countmatrix.to_dict)
+    args = (countmatrix, rowdictA, trialsA, countsB, prop, len(corpB))
+    indicators = np.zeros(len(countmatrix.vocab), dtype=np.int64)
+    indicators, N = bp.run_repetitions(matrix_repetition, args, indicators, repeats, interval, check, workers=workers, seed=seed)
+
+    logging.info("Generating candidates")
+    candidates = [(term, (value + 1) / (N + 1)) for (term, value) in countmatrix.to_dict(indicators).items()]
+    sortedlist = sorted(candidates, key=operator.itemgetter(1), reverse=True)
+    return sortedlist
+
+def label_rng(seed):
+    #numpy generator for the random labels of a batch: seeded from seed (which may be a string) or fresh
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng(random.Random("{}:labels".format(seed)).getrandbits(64))
+
+
+def random_labels(wdf, Areqs, rng=None):
+    #batch version of update_random: each requirement list gets its own random A/B column per random2_N
+    #proportion, as update_random drew a new labelling for every experiment.  Within a list both sides (A and
+    #the negation which makes B) use the same column.  The columns are added to the frame in a single copy
+    if rng is None:
+        rng = np.random.default_rng()
+    columns = {}
+    Breqs = []
+    for (i, Areqlist) in enumerate(Areqs):
+        Breqlist = []
+        for (field, value) in Areqlist:
+            if field.startswith("random2"):
+                prop = int(field.split("_")[1])
+                column = "rchoice_{}_{}".format(i, prop)
+                if column not in columns:
+                    columns[column] = np.where(100*rng.random(len(wdf)) < prop, 'A', 'B')
+                Breqlist.append((column, value))
+            else:
+                Breqlist.append((field, value))
+        Breqs.append(Breqlist)
+    return (wdf.assign(**columns), Breqs)
+
+
+class ExperimentBatch:
+    #runs bootstrap_compare for several A requirement lists against the same allreqs, computing the shared
+    #pieces once: the words frame restricted to allreqs (with the random labels), its TrialIndex and value
+    #catalogue, the count matrix or analysis cache, and corpus B for each distinct set of B requirements
+
+    def __init__(self, allreqs, worddata, trialdata, Areqs, engine='corpus', cache=None, convergence=None, seed=None):
+        #convergence is None to use check_convergence, or a dict of ConvergenceTracker parameters.
+        #seed makes the random2_N labels repeatable (give run_all the same seed)
+        self.convergence = convergence
+        self.allreqs = allreqs
+        self.trialdata = trialdata
+        self.engine = engine
+        self.cache = cache
+        self.shared = {}
+
+        logging.info("Restricting words to the base requirements")
+        base = RequirementQuery(allreqs)
+        trials = find_trials(worddata, trialdata, base)
+        basedata = base.select(worddata)
+        basedata = basedata[basedata['obo_trial'].isin(trials if trials is not None else [])]
+        logging.info("{} of {} utterances meet the base requirements".format(len(basedata), len(worddata)))
+
+        logging.info("Checking for random requirements")
+        basedata, self.Areqs = random_labels(basedata, Areqs, rng=label_rng(seed))
+        self.index = TrialIndex(basedata)
+        value_catalogue(self.index.data)
+        if engine == 'matrix':
+            self.countmatrix = CountMatrix(nlp)
+            logging.info("Analysing utterances")
+            self.countmatrix.add(self.index.data['words'])
+            self.countmatrix.get_matrix()
+        else:
+            self.countmatrix = None
+
+    def run(self, i, outfile_stem, repeats=10, prop=100, interval=100, workers=1, seed=None):
+        #the i-th experiment of the batch
+        Breq = self.Areqs[i]
+        if self.convergence is not None:
+            #the default margin depends on the number of repeats of this run
+            options = {'repeats': repeats}
+            options.update(self.convergence)
+            tracker = BootstrapConvergence.ConvergenceTracker(outfile_stem=outfile_stem, **options)
+        else:
+            tracker = None
+        if self.engine == 'matrix':
+            return bootstrap_compare_matrix(Breq, self.allreqs, self.index.data, self.trialdata, index=self.index,
+                                            countmatrix=self.countmatrix, shared=self.shared, tracker=tracker, repeats=repeats,
+                                            prop=prop, interval=interval, outfile_stem=outfile_stem, workers=workers, seed=seed)
+        return bootstrap_compare(Breq, self.allreqs, self.index.data, self.trialdata, index=self.index, cache=self.cache,
+                                 shared=self.shared, tracker=tracker, repeats=repeats, prop=prop, interval=interval,
+                                 outfile_stem=outfile_stem, workers=workers, seed=seed)
+
+    def prepare(self, prop=100):
+        #build every distinct corpus B in this process, so that concurrent experiments inherit them
+        for Breq in self.Areqs:
+            queryB = RequirementQuery(self.allreqs + negate(Breq))
+            keyB = (repr(queryB.reqlist), prop)
+            if keyB not in self.shared:
+                trialsB = find_trials(self.index.data, self.trialdata, queryB)
+                corpB = generate_corpus(self.index.data, trialsB, queryB, prop=prop, index=self.index)
+                if self.engine == 'matrix':
+                    self.shared[keyB] = (corpB, self.countmatrix.add(corpB))
+                else:
+                    corpusB = nlp_tools.corpus(corpB, nlp, prop=100, ner=False, loadfiles=False, cache=self.cache)
+                    self.shared[keyB] = (corpB, corpusB)
+
+    def run_all(self, outfiles, repeats=10, prop=100, interval=100, workers=1, seed=None, concurrent=1):
+        #run every experiment, concurrent of them at a time.  Concurrent experiments run their own repetitions
+        #serially, and experiment i uses the seed "seed/i" so that the results do not depend on concurrent
+        if concurrent <= 1:
+            return [self.run(i, outfile, repeats=repeats, prop=prop, interval=interval, workers=workers,
+                             seed=seed if seed is None else "{}/{}".format(seed, i)) for (i, outfile) in enumerate(outfiles)]
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+            logging.info("No seed given, using seed {}".format(seed))
+        self.prepare(prop=prop)
+        jobs = [(i, outfile, repeats, prop, interval, "{}/{}".format(seed, i)) for (i, outfile) in enumerate(outfiles)]
+        with Pool(concurrent, initializer=_init_batch, initargs=(self,)) as pool:
+            return pool.map(_run_batch, jobs)
+
+
+_batch = {}
+
+
+def _init_batch(batch):
+    #the sqlite connection of the analysis cache cannot be shared with a forked process
+    if batch.cache is not None:
+        batch.cache = batch.cache.reopen()
+    _batch['batch'] = batch
+
+
+def _run_batch(job):
+    (i, outfile, repeats, prop, interval, seed) = job
+    return _batch['batch'].run(i, outfile, repeats=repeats, prop=prop, interval=interval, seed=seed)
+
+
+def null_model_compare(Areqs, allreqs, worddata, trialdata, repeats=10, prop=100, index=None, countmatrix=None, seed=None):
+    #null model calibration for random2_N requirements in one pass, without building a labelled frame per split.
+    #Every utterance meeting allreqs gets a random A/B label per proportion N (a boolean array), and for each
+    #label side the utterance x term count matrix is summed into a trial x term matrix.  Each repetition draws
+    #one sequence of trials which is shared by every split; corpus A of a side is the labelled utterances of the
+    #prefix of the sequence reaching the size of that side's corpus B, as in bootstrap_compare.
+    #Returns a list aligned with Areqs of sorted (term, score) candidates - every term scoring highly is a false
+    #positive - or None for requirement lists which are not a single random2_N requirement
+    if index is None:
+        index=TrialIndex(worddata)
+    if countmatrix is None:
+        countmatrix=CountMatrix(nlp)
+    rng=np.random.default_rng(seed)
+    query=RequirementQuery(allreqs)
+    trials=find_trials(index.data, trialdata, query)
+    tids={}
+    for atrial in trials:
+        tids.setdefault(atrial, len(tids))
+    tlist=np.array([tids[atrial] for atrial in trials], dtype=np.int64)
+    T=len(tids)
+    logging.info("{} trials in the null model".format(T))
+
+    #every utterance of the distinct trials: its trial id and row of the count matrix
+    utttrials=[]
+    uttrows=[]
+    for (atrial, tid) in tids.items():
+        rows=countmatrix.add([line for line in index.get(atrial, query)['words']])
+        utttrials.append(np.full(len(rows), tid, dtype=np.int64))
+        uttrows.append(rows)
+    utttrials=np.concatenate(utttrials) if T>0 else np.zeros(0, dtype=np.int64)
+    uttrows=np.concatenate(uttrows) if T>0 else np.zeros(0, dtype=np.int64)
+    M=countmatrix.get_matrix()
+    logging.info("Count matrix has {} utterances and {} terms".format(M.shape[0], M.shape[1]))
+
+    def side(mask):
+        #number of utterances per trial and trial x term counts for the utterances in mask
+        incidence=sparse.csr_matrix((np.ones(mask.sum(), dtype=np.int64), (utttrials[mask], uttrows[mask])), shape=(T, M.shape[0]))
+        return (np.bincount(utttrials[mask], minlength=T), (incidence * M).tocsc())
+
+    N=int(len(tlist)*prop/100)
+    K=min(N+1, len(tlist))
+    firstK=np.bincount(tlist[:K], minlength=T)
+    labels={}
+    experiments=[]
+    for Areqlist in Areqs:
+        if len(Areqlist)!=1 or not Areqlist[0][0].startswith("random2"):
+            logging.warning("Null model only runs single random2_N requirements, skipping {}".format(Areqlist))
+            experiments.append(None)
+            continue
+        (field, value)=Areqlist[0]
+        split=int(field.split("_")[1])
+        if split not in labels:
+            #the same labels for both sides of a split: A with probability split%
+            labelA=rng.random(len(utttrials))*100 < split
+            labels[split]={'A': side(labelA), 'B': side(~labelA)}
+        (sizesA, countsA)=labels[split][value]
+        (sizesB, countsB)=labels[split]['B' if value=='A' else 'A']
+        #corpus B is the first trials in order as generate_corpus takes them
+        experiments.append({'sizes': sizesA, 'counts': countsA, 'countsB': countsB.T.dot(firstK),
+                            'size': int(sizesB.dot(firstK)), 'indicators': np.zeros(M.shape[1], dtype=np.int64)})
+
+    for j in range(0, repeats):
+        sequence=tlist[rng.integers(0, len(tlist), N+1)]
+        for experiment in experiments:
+            if experiment is None:
+                continue
+            k=N+1
+            if experiment['size']>0:
+                reached=np.flatnonzero(np.cumsum(experiment['sizes'][sequence])>=experiment['size'])
+                if len(reached)>0:
+                    k=min(k, reached[0]+1)
+            weights=np.bincount(sequence[:k], minlength=T)
+            compare_counts(experiment['counts'].T.dot(weights), experiment['countsB'], experiment['indicators'])
+        if (j+1)%10==0:
+            logging.info("Completed {} null model repetitions".format(j+1))
+
+    results=[]
+    for experiment in experiments:
+        if experiment is None:
+            results.append(None)
+        else:
+            candidates=[(term, (value + 1) / (repeats + 1)) for (term, value) in countmatrix.to_dict(experiment['indicators']).items()]
+            results.append(sorted(candidates, key=operator.itemgetter(1), reverse=True))
+    return results
+
+
+def false_positives(candidates, thresholds=(0.9, 0.95, 0.99)):
+    #number of terms above each score threshold in a null model result
+    return {t: sum(1 for (_term, score) in candidates if score > t) for t in thresholds}
+
+
 def update_random(wdf,Areqlist):
 
     #check to see if Areq is a "random" requirement
@@ -327,19 +845,40 @@ if __name__=="__main__":
 
     logging.basicConfig(level=logging.INFO)
     parentdir=myconfig.get('default','parentdir')
-    worddata = pd.DataFrame.from_csv(os.path.join(parentdir,myconfig.get('default','worddatafile')), sep='\t')
-    trialdata = pd.DataFrame.from_csv(os.path.join(parentdir,myconfig.get('default','trialdatafile')), sep='\t')
+    worddata = obv_cache.load_tsv(os.path.join(parentdir,myconfig.get('default','worddatafile')))
+    trialdata = obv_cache.load_tsv(os.path.join(parentdir,myconfig.get('default','trialdatafile')))
 
     outfiles=ast.literal_eval(myconfig.get('default','outfile'))
 
     allreqlist = ast.literal_eval(myconfig.get('default','allreqlist'))
     Areqs=ast.literal_eval(myconfig.get('default','Areqs'))
+    engine=myconfig.get('default','engine',fallback='corpus')
+    workers=myconfig.getint('default','workers',fallback=1)
+    seed=myconfig.getint('default','seed',fallback=None)
+    #number of Areqs experiments to run at the same time
+    concurrent=myconfig.getint('default','concurrent',fallback=1)
+    #convergence=tracker stops on confidence bounds (BootstrapConvergence) rather than check_convergence
+    if myconfig.get('default','convergence',fallback='')=='tracker':
+        convergence={'threshold':myconfig.getfloat('default','threshold',fallback=0.9),'confidence':myconfig.getfloat('default','confidence',fallback=0.99),'margin':myconfig.getfloat('default','margin',fallback=None)}
+    else:
+        convergence=None
+    cachefile=myconfig.get('default','cachefile',fallback='')
+    if cachefile:
+        cache=nlp_tools.AnalysisCache(cachefile,nlp,maxsize=myconfig.getint('default','cachesize',fallback=1000000))
+    else:
+        cache=None
+
+    if engine=='null':
+        allcandidates=null_model_compare(Areqs,allreqlist,worddata,trialdata,repeats=myconfig.getint('default','repeats'),prop=myconfig.getint('default','prop'),seed=seed)
+        for Areq,candidates in zip(Areqs,allcandidates):
+            if candidates is not None:
+                logging.info("False positives for {}: {}".format(Areq,false_positives(candidates)))
+        allcandidates=[candidates if candidates is not None else [] for candidates in allcandidates]
+    else:
+        batch=ExperimentBatch(allreqlist,worddata,trialdata,Areqs,engine=engine,cache=cache,convergence=convergence,seed=seed)
+        allcandidates=batch.run_all(outfiles,repeats=myconfig.getint('default','repeats'),prop=myconfig.getint('default','prop'),interval=myconfig.getint('default','interval'),workers=workers,seed=seed,concurrent=concurrent)
 
-    for Areq,outfile in zip(Areqs,outfiles):
-        #print(Areq)
-        logging.info("Checking for random requirements")
-        myworddata,Breq=update_random(worddata,Areq)
-        candidates=bootstrap_compare(Breq,allreqlist,myworddata,trialdata,repeats=myconfig.getint('default','repeats'),prop=myconfig.getint('default','prop'),interval=myconfig.getint('default','interval'),outfile_stem=outfile)
+    for candidates,outfile in zip(allcandidates,outfiles):
         logging.info(candidates[:10])
         surprising=[(cand,score) for (cand,score) in candidates if score > 0.9]
         logging.info(len(surprising))
@@ -349,4 +888,3 @@ if __name__=="__main__":
                     break
                 else:
                     outstream.write("{}\t{}\n".format(term,score))
-
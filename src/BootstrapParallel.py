@@ -0,0 +1,78 @@
+import random
+import logging
+import math
+from multiprocessing import Pool
+from time import time
+
+# Running bootstrap repetitions in a process pool.
+# Repetition j always draws from its own random.Random seeded from (seed, j), so the merged indicator counts
+# depend only on the seed and not on the number of workers or on which worker ran which repetition.
+
+_worker = {}
+
+
+def repetition_rng(seed, j):
+    if seed is None:
+        return random
+    return random.Random("{}:{}".format(seed, j))
+
+
+def merge_counts(indicators, partial):
+    #add the indicator counts of one repetition (a dict of term counts or an array) into the running total
+    if isinstance(indicators, dict):
+        for (term, value) in partial.items():
+            indicators[term] = indicators.get(term, 0) + value
+    else:
+        indicators += partial
+    return indicators
+
+
+def _init_worker(repetition, args):
+    _worker['repetition'] = repetition
+    _worker['args'] = args
+
+
+def _run_repetition(job):
+    (j, seed) = job
+    return _worker['repetition'](*_worker['args'], rng=repetition_rng(seed, j))
+
+
+def run_repetitions(repetition, args, indicators, repeats, interval, check, workers=1, seed=None):
+    #repetition(*args, rng=rng) returns the indicator counts of a single repetition, which are merged into indicators.
+    #Every interval repetitions check(indicators, N) is called and returning True stops early.
+    #If check has an update method (e.g. BootstrapConvergence.ConvergenceTracker) it is given every repetition's counts
+    #Returns the merged indicators and the number of repetitions they cover
+    if workers <= 1:
+        for j in range(0, repeats):
+            starttime = time()
+            logging.info("Bootstrapping repetition {}".format(j))
+            partial = repetition(*args, rng=repetition_rng(seed, j))
+            indicators = merge_counts(indicators, partial)
+            if hasattr(check, 'update'):
+                check.update(partial)
+            logging.info("Time taken for this iteration: {}".format(time() - starttime))
+            if (j + 1) % interval == 0 and check(indicators, j + 1):
+                return indicators, j + 1
+        return indicators, repeats
+
+    if seed is None:
+        #workers forked from one process would otherwise share the state of the global random module
+        seed = random.randrange(2 ** 32)
+        logging.info("No seed given, using seed {}".format(seed))
+
+    #rounds are a whole number of intervals and keep every worker busy.  Partial counts are merged in
+    #repetition order and checked at each interval, so a run stops at the same N as the serial one would
+    roundsize = interval * math.ceil(workers / interval)
+    with Pool(workers, initializer=_init_worker, initargs=(repetition, args)) as pool:
+        for start in range(0, repeats, roundsize):
+            starttime = time()
+            jobs = [(j, seed) for j in range(start, min(start + roundsize, repeats))]
+            partials = pool.map(_run_repetition, jobs)
+            logging.info("Repetitions {} to {} took {}".format(start, start + len(jobs) - 1, time() - starttime))
+            for ((j, _seed), partial) in zip(jobs, partials):
+                indicators = merge_counts(indicators, partial)
+                if hasattr(check, 'update'):
+                    check.update(partial)
+                if (j + 1) % interval == 0 and check(indicators, j + 1):
+                    return indicators, j + 1
+    return indicators, repeats
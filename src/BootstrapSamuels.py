@@ -10,6 +10,8 @@ import configparser,ast,os,sys
 from time import time
 import CharacterisingFunctions as cf
 import csv
+import BootstrapParallel as bp
+import BootstrapConvergence
 
 
 def process_header(header):
@@ -167,25 +169,21 @@ class Samuels:
         docs.append(text)
         return docs
 
-    def make_bow(self, field='vard', k=100000,bootstrap=False,params={}):
+    def make_bow(self, field='vard', k=100000,bootstrap=False,params={},rng=random):
         # turn corpus into a bag of words for a certain field - variant of make_hfw_dist()
+        # returns a CharacterisingFunctions.FreqDist of the k most frequent
 
-        sumdict = {}
-        corpussize = 0
         if bootstrap:
-            df =self.get_bootstrap(prop=params.get('prop',100),size=params.get('size',0))
+            df =self.get_bootstrap(prop=params.get('prop',100),size=params.get('size',0),rng=rng)
         else:
             df = self.get_dataframe()
         df = df[df['LEMMA'] != 'NULL']
         if self.lowercase and field=='vard':
             field='vard_lower'
-        for item in df[field]:
-            sumdict[item] = sumdict.get(item, 0) + 1
-            corpussize += 1
+        dist = cf.FreqDist.from_values(df[field])
 
-        logging.info("Size of corpus is {}".format(corpussize))
-        candidates = sorted(sumdict.items(), key=operator.itemgetter(1), reverse=True)
-        return corpussize, candidates[:k]
+        logging.info("Size of corpus is {}".format(dist.size))
+        return dist.top(k)
 
     def find_text(self, semtag, field='SEMTAG3'):
 
@@ -200,7 +198,7 @@ class Samuels:
         mylist = list(mylemmas[0:10].index.values)
         return mylist
 
-    def get_bootstrap(self,prop=100,size=0):
+    def get_bootstrap(self,prop=100,size=0,rng=random):
 
         N=self.chunks
         df=self.get_dataframe()
@@ -210,7 +208,7 @@ class Samuels:
         i=0
         while cont:
 
-            chosenchunk=random.randint(0,N-1)
+            chosenchunk=rng.randint(0,N-1)
             if i==0:
                 self.bootstrap=df[df['chunk']==chosenchunk]
             else:
@@ -223,26 +221,20 @@ class Samuels:
         return self.bootstrap
 
 def make_dict(distA):
-    size,alist=distA
-    adict={}
-    for(word,freq) in alist:
-        adict[word]=freq
-    return size,adict
+    #a FreqDist (which has O(1) lookup) of a FreqDist or a pair of size and list of tuples (word,frequencies)
+    return cf.as_freqdist(distA)
 
 
 def compare(distA,distB,indicatordict):
-    #distA is a pair of size and list of tuples (word,frequencies)
-    #distB is a pair of size and lookup dict
-
-    sizeA, hfwA = distA
-    sizeB, hfwBdict = distB
-
-    for (word, freqA) in hfwA:
-        freqB = hfwBdict.get(word, 0)
-        probA = freqA / sizeA
-        probB = freqB / sizeB
-        if probA > probB:
-            indicatordict[word] = indicatordict.get(word, 0) + 1
+    #distA and distB are FreqDists (or pairs of size and list of tuples (word,frequencies))
+    #add one to the indicator of every word of distA more probable in A than in B
+
+    distA = cf.as_freqdist(distA)
+    distB = cf.as_freqdist(distB)
+    countsA, countsB = distA.align(distB)
+    for i in np.flatnonzero(countsA / distA.size > countsB / distB.size):
+        word = distA.terms[i]
+        indicatordict[word] = indicatordict.get(word, 0) + 1
     return indicatordict
 
 def check_convergence(newdict,cache,outfile,N,t=0.9):
@@ -279,26 +271,33 @@ def check_convergence(newdict,cache,outfile,N,t=0.9):
 
 
 
-def bootstrap_compare(samA,samB,repeats=10,prop=100,interval=100,field='vard',outfile_stem='words'):
+def convergence_check(outfile_stem):
+    #check function for BootstrapParallel.run_repetitions which keeps the previous check_convergence cache
+    cacheddict = {}
 
-    logging.info("Generating corpus B distribution")
-    distB=make_dict(samB.make_bow(field=field))
-    sizeB=distB[0]
-    indicatordict={}
-    cacheddict={}
-    N=repeats
-    for j in range(0,repeats):
-        logging.info("Bootstrapping corpus A repetition {}".format(j))
-        distA=samA.make_bow(bootstrap=True,field=field,params={'prop':prop,'size':sizeB})
+    def check(indicators, N):
+        nonlocal cacheddict
+        cacheddict, stop = check_convergence(indicators, cacheddict, outfile_stem + "_" + str(N), N)
+        return stop
 
-        indicatordict=compare(distA,distB,indicatordict)
+    return check
 
-        if (j+1)%interval==0:
-            cacheddict,stop=check_convergence(indicatordict,cacheddict,outfile_stem+"_"+str(j+1),j+1)
 
-            if stop:
-                N=j+1
-                break
+def bootstrap_repetition(samA, distB, field, prop, rng=random):
+    distA=samA.make_bow(bootstrap=True,field=field,params={'prop':prop,'size':distB.size},rng=rng)
+    return compare(distA,distB,{})
+
+
+def bootstrap_compare(samA,samB,repeats=10,prop=100,interval=100,field='vard',outfile_stem='words',workers=1,seed=None,tracker=None):
+    #tracker is an optional BootstrapConvergence.ConvergenceTracker used instead of check_convergence
+    #workers > 1 runs the repetitions in a process pool; with a seed the result is the same for any number of workers
+
+    logging.info("Generating corpus B distribution")
+    distB=make_dict(samB.make_bow(field=field))
+    #build the frame before any workers are forked so that they share it
+    samA.get_dataframe()
+    check=tracker if tracker is not None else convergence_check(outfile_stem)
+    indicatordict,N=bp.run_repetitions(bootstrap_repetition,(samA,distB,field,prop),{},repeats,interval,check,workers=workers,seed=seed)
 
     logging.info("Generating candidates")
     candidates = [(term, (value + 1) / (N + 1)) for (term, value) in indicatordict.items()]
@@ -362,7 +361,11 @@ if __name__=="__main__":
         Afiles = ast.literal_eval(myconfig.get('default', 'Afiles'))
         Bfiles = ast.literal_eval(myconfig.get('default', 'Bfiles'))
         field=myconfig.get('default','field')
+        workers=myconfig.getint('default','workers',fallback=1)
+        seed=myconfig.getint('default','seed',fallback=None)
         outfile=myconfig.get('default','outfile')+"_"+field
+        #convergence=tracker stops on confidence bounds (BootstrapConvergence) rather than check_convergence
+        usetracker=myconfig.get('default','convergence',fallback='')=='tracker'
 
 
         Apaths=[os.path.join(parentdir,f) for f in Afiles]
@@ -372,7 +375,8 @@ if __name__=="__main__":
         samB=Samuels(Bpaths)
 
 
-        candidates = bootstrap_compare(samA,samB,field=field,repeats=myconfig.getint('default', 'repeats'),prop=myconfig.getint('default', 'prop'),interval=myconfig.getint('default', 'interval'), outfile_stem=outfile+"_A")
+        candidates = bootstrap_compare(samA,samB,field=field,workers=workers,seed=seed,repeats=myconfig.getint('default', 'repeats'),prop=myconfig.getint('default', 'prop'),interval=myconfig.getint('default', 'interval'), outfile_stem=outfile+"_A",
+                                       tracker=BootstrapConvergence.ConvergenceTracker(outfile_stem=outfile+"_A",repeats=myconfig.getint('default', 'repeats')) if usetracker else None)
         logging.info(candidates[:10])
         surprising = [(cand, score) for (cand, score) in candidates if score > 0.9]
         logging.info(len(surprising))
@@ -384,9 +388,10 @@ if __name__=="__main__":
                     outstream.write("{}\t{}\n".format(term, score))
 
 
-        candidates = bootstrap_compare(samB, samA, field=field, repeats=myconfig.getint('default', 'repeats'),
+        candidates = bootstrap_compare(samB, samA, field=field, workers=workers, seed=seed, repeats=myconfig.getint('default', 'repeats'),
                                        prop=myconfig.getint('default', 'prop'),
-                                       interval=myconfig.getint('default', 'interval'), outfile_stem=outfile+"_B")
+                                       interval=myconfig.getint('default', 'interval'), outfile_stem=outfile+"_B",
+                                       tracker=BootstrapConvergence.ConvergenceTracker(outfile_stem=outfile+"_B",repeats=myconfig.getint('default', 'repeats')) if usetracker else None)
         logging.info(candidates[:10])
         surprising = [(cand, score) for (cand, score) in candidates if score > 0.9]
         logging.info(len(surprising))
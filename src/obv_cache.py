@@ -0,0 +1,264 @@
+import pandas as pd
+import numpy as np
+import logging
+import json,os,shutil
+from itertools import chain
+from pandas.api.extensions import ExtensionArray, ExtensionDtype, register_extension_dtype, take
+
+# Loading the OBV2 tsv files (obv_words_v2_*.tsv, obv_defendants_trials.tsv etc.) through a columnar binary cache.
+# The first load parses the tsv and writes each column to <file>.cache/ as a typed numpy array: the CATEGORICAL
+# columns (roles, sex, offence categories ...) become categoricals, integer columns (e.g. year) are downcast and
+# other text is stored as one utf-8 buffer with offsets.  Later loads memory-map the arrays.  Free text (e.g. words)
+# stays in the mapped buffer as a TextArray and is only decoded when it is read; other text columns (trial ids
+# etc., which are compared and joined on) are decoded into object arrays.
+# The cache is rebuilt whenever the size or modification time of the source file changes.
+
+CACHE_VERSION = 3
+
+#the only categorical columns
+CATEGORICAL = ['obc_role', 'obv_role', 'obc_sex', 'deft_sex', 'deft_offcat', 'deft_offsubcat', 'deft_vercat',
+               'deft_puncat', 'obv_words_type', 'obc_class']
+#text columns which are kept memory-mapped
+FREETEXT = ['words']
+
+INDEX = '__index__'
+
+
+def cache_dir(path):
+    return path + ".cache"
+
+
+def source_stamp(path):
+    stat = os.stat(path)
+    return {'version': CACHE_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def read_tsv(path):
+    #same as the DataFrame.from_csv(path, sep='\t') calls this replaces, except that nothing is parsed as dates:
+    #parse_dates would try (and warn) on every index, and could turn trial ids into dates
+    return pd.read_csv(path, sep='\t', index_col=0, low_memory=False)
+
+
+def load_tsv(path, cachedir=None, rebuild=False):
+    if cachedir is None:
+        cachedir = cache_dir(path)
+    stamp = source_stamp(path)
+    metafile = os.path.join(cachedir, 'meta.json')
+    if not rebuild and os.path.exists(metafile):
+        with open(metafile) as instream:
+            meta = json.load(instream)
+        if meta['source'] == stamp:
+            logging.info("Loading {} from cache {}".format(path, cachedir))
+            return read_cache(cachedir, meta)
+        logging.info("Cache {} is out of date".format(cachedir))
+    logging.info("Reading {}".format(path))
+    df = read_tsv(path)
+    write_cache(df, cachedir, stamp)
+    return read_cache(cachedir)
+
+
+def column_kind(name, column):
+    if name in CATEGORICAL:
+        return 'category'
+    if pd.api.types.is_bool_dtype(column):
+        return 'bool'
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return 'datetime'
+    if pd.api.types.is_integer_dtype(column):
+        return 'int'
+    if pd.api.types.is_float_dtype(column):
+        return 'float'
+    if name in FREETEXT:
+        return 'freetext'
+    return 'text'
+
+
+def write_column(name, column, cachedir, i):
+    kind = column_kind(name, column)
+    stem = os.path.join(cachedir, str(i))
+    spec = {'name': name, 'kind': kind}
+    if kind == 'category':
+        values = pd.Categorical(column)
+        #categories are stored as json so keep them json-compatible
+        spec['categories'] = [v.item() if isinstance(v, np.generic) else v for v in values.categories]
+        if values.categories.dtype.kind == 'M':
+            spec['categories'] = [str(v) for v in values.categories]
+            spec['kind'] = kind = 'datetime_category'
+        np.save(stem + '.npy', values.codes)
+    elif kind == 'int':
+        np.save(stem + '.npy', pd.to_numeric(column, downcast='integer').values)
+    elif kind == 'datetime':
+        np.save(stem + '.npy', column.values.astype('datetime64[ns]').view(np.int64))
+    elif kind == 'text' or kind == 'freetext':
+        nulls = column.isna().values
+        encoded = [b'' if null else str(v).encode('utf-8') for (v, null) in zip(column.values, nulls)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        with open(stem + '.bin', 'wb') as outstream:
+            outstream.write(b''.join(encoded))
+        np.save(stem + '.npy', offsets)
+        np.save(stem + '_null.npy', nulls)
+    else:
+        np.save(stem + '.npy', column.values)
+    return spec
+
+
+def write_cache(df, cachedir, stamp):
+    #write to a temporary directory and move it into place so that a failed write leaves no half cache
+    tmpdir = cachedir + ".tmp"
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    columns = [write_column(INDEX, df.index.to_series(), tmpdir, 0)]
+    for i, name in enumerate(df.columns):
+        columns.append(write_column(name, df[name], tmpdir, i + 1))
+    meta = {'source': stamp, 'rows': len(df), 'index_name': df.index.name, 'columns': columns}
+    with open(os.path.join(tmpdir, 'meta.json'), 'w') as outstream:
+        json.dump(meta, outstream)
+    if os.path.exists(cachedir):
+        shutil.rmtree(cachedir)
+    os.replace(tmpdir, cachedir)
+    logging.info("Wrote cache {} ({} rows, {} columns)".format(cachedir, len(df), len(df.columns)))
+
+
+def read_column(spec, cachedir, i):
+    stem = os.path.join(cachedir, str(i))
+    kind = spec['kind']
+    values = np.load(stem + '.npy', mmap_mode='r')
+    if kind == 'category':
+        return pd.Categorical.from_codes(values, categories=spec['categories'])
+    if kind == 'datetime_category':
+        return pd.Categorical.from_codes(values, categories=pd.to_datetime(spec['categories']))
+    if kind == 'datetime':
+        return values.view('datetime64[ns]')
+    if kind == 'text' or kind == 'freetext':
+        nulls = np.load(stem + '_null.npy')
+        if os.path.getsize(stem + '.bin') > 0:
+            buffer = np.memmap(stem + '.bin', dtype=np.uint8, mode='r')
+        else:
+            buffer = np.zeros(0, dtype=np.uint8)
+        text = TextArray.from_buffer(buffer, values, nulls)
+        if kind == 'text':
+            return np.array(text, dtype=object)
+        return text
+    return values
+
+
+def read_cache(cachedir, meta=None):
+    if meta is None:
+        with open(os.path.join(cachedir, 'meta.json')) as instream:
+            meta = json.load(instream)
+    columns = meta['columns']
+    index = pd.Index(read_column(columns[0], cachedir, 0), name=meta['index_name'])
+    data = {}
+    for i, spec in enumerate(columns[1:]):
+        data[spec['name']] = read_column(spec, cachedir, i + 1)
+    return pd.DataFrame(data, index=index, columns=[spec['name'] for spec in columns[1:]], copy=False)
+
+
+# A TextArray is a read-only pandas column of strings held in a utf-8 buffer (memory-mapped from the cache) with
+# offsets.  rows picks out and orders the rows of the buffer (-1 for a missing value), so slicing, filtering and
+# sorting a frame only take rows; a string is decoded when it is read
+
+@register_extension_dtype
+class TextDtype(ExtensionDtype):
+    name = 'obv_text'
+    type = str
+    kind = 'O'
+    na_value = np.nan
+
+    @classmethod
+    def construct_array_type(cls):
+        return TextArray
+
+
+class TextArray(ExtensionArray):
+
+    def __init__(self, buffer, offsets, rows):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.rows = rows
+
+    @classmethod
+    def from_buffer(cls, buffer, offsets, nulls):
+        rows = np.arange(len(nulls), dtype=np.int64)
+        rows[nulls] = -1
+        return cls(buffer, offsets, rows)
+
+    @classmethod
+    def _from_sequence(cls, scalars, dtype=None, copy=False):
+        values = list(scalars)
+        nulls = np.array([not isinstance(v, str) and pd.isna(v) for v in values], dtype=bool)
+        encoded = [b'' if null else str(v).encode('utf-8') for (v, null) in zip(values, nulls)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return cls.from_buffer(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets, nulls)
+
+    @classmethod
+    def _from_factorized(cls, values, original):
+        return cls._from_sequence(values)
+
+    @property
+    def dtype(self):
+        return TextDtype()
+
+    @property
+    def nbytes(self):
+        #the buffer is mapped and shared, so only the rows count
+        return self.rows.nbytes
+
+    def __len__(self):
+        return len(self.rows)
+
+    def value(self, row):
+        if row < 0:
+            return np.nan
+        return self.buffer[self.offsets[row]:self.offsets[row + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for row in self.rows.tolist():
+            yield self.value(row)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return self.value(int(self.rows[item]))
+        if not isinstance(item, slice):
+            item = pd.api.indexers.check_array_indexer(self, item)
+        return TextArray(self.buffer, self.offsets, self.rows[item])
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(list(self), dtype=object if dtype is None else dtype)
+
+    def __eq__(self, other):
+        return np.array(self, dtype=object) == other
+
+    def __getattr__(self, name):
+        #the .str methods (_str_len, _str_lower ...) work on the decoded strings, as on an object column
+        if name.startswith('_str_'):
+            return getattr(pd.arrays.NumpyExtensionArray(np.array(self, dtype=object)), name)
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+
+    def isna(self):
+        return self.rows < 0
+
+    def take(self, indices, allow_fill=False, fill_value=None):
+        if allow_fill and fill_value is not None and not pd.isna(fill_value):
+            return TextArray._from_sequence(take(np.array(self, dtype=object), indices, allow_fill=True,
+                                                 fill_value=fill_value))
+        return TextArray(self.buffer, self.offsets, take(self.rows, indices, allow_fill=allow_fill, fill_value=-1))
+
+    def copy(self):
+        return TextArray(self.buffer, self.offsets, self.rows.copy())
+
+    @classmethod
+    def _concat_same_type(cls, to_concat):
+        first = to_concat[0]
+        if all(array.buffer is first.buffer and array.offsets is first.offsets for array in to_concat):
+            return cls(first.buffer, first.offsets, np.concatenate([array.rows for array in to_concat]))
+        return cls._from_sequence(chain.from_iterable(to_concat))
+
+    def _values_for_factorize(self):
+        return np.array(self, dtype=object), np.nan
+
+    def _values_for_argsort(self):
+        return np.array(['' if row < 0 else value for (row, value) in zip(self.rows.tolist(), self)], dtype=object)
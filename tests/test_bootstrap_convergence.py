@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import BootstrapConvergence
+import BootstrapParallel as bp
+
+# the probability that each term is more probable in corpus A in a repetition; none is at the threshold itself
+PROPORTIONS = {'watch': 0.99, 'pocket': 0.93, 'coat': 0.8, 'gentleman': 0.6, 'prisoner': 0.2}
+
+
+def repetition(rng):
+    return {term: int(rng.random() < p) for (term, p) in PROPORTIONS.items()}
+
+
+def test_default_margin_follows_repeats():
+    tracker = BootstrapConvergence.ConvergenceTracker(repeats=250)
+    assert tracker.margin == pytest.approx(0.06, abs=0.002)
+    assert tracker.half_width(0.9 - tracker.margin, 250) == pytest.approx(tracker.margin)
+    assert BootstrapConvergence.ConvergenceTracker(repeats=1000).margin < tracker.margin
+    assert BootstrapConvergence.ConvergenceTracker(margin=0.02).margin == 0.02
+
+
+def test_default_margin_stops_within_repeats():
+    tracker = BootstrapConvergence.ConvergenceTracker(repeats=250)
+    (indicators, N) = bp.run_repetitions(repetition, (), {}, 250, 5, tracker, seed='tracker')
+    assert N < 250 and tracker.projected == 0
+
+    narrow = BootstrapConvergence.ConvergenceTracker(margin=0.02)
+    (indicators, N) = bp.run_repetitions(repetition, (), {}, 250, 5, narrow, seed='tracker')
+    assert N == 250 and narrow.projected > 250
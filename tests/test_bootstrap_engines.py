@@ -0,0 +1,64 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+pytest.importorskip('spacy')
+pytest.importorskip('matplotlib')
+import BootstrapCorpus as bc
+
+
+class Token:
+    def __init__(self, text):
+        self.text = text
+        self.pos_ = 'NOUN' if text.isalpha() else 'PUNCT'
+        self.lemma_ = text.lower()
+        self.is_stop = self.lemma_ in ('the', 'a', 'i')
+        self.is_oov = False
+
+
+class Doc(list):
+    # a parsed document with a sentence ending at each full stop
+    @property
+    def sents(self):
+        sents = [[]]
+        for token in self:
+            sents[-1].append(token)
+            if token.text == '.':
+                sents.append([])
+        return [sent for sent in sents if sent]
+
+
+def stub_model(text):
+    return Doc(Token(word) for word in text.replace('.', ' .').split())
+
+
+@pytest.fixture
+def frames():
+    words = 'The cat sat on a mat . I stole it . London is big . horse ran away'.split()
+    rows = []
+    for t in range(40):
+        for u in range(1 + t % 4):
+            utterance = ' '.join(words[(t * 7 + u * 3 + i) % len(words)] for i in range(2 + (t + u) % 7))
+            rows.append({'obo_trial': 't{}'.format(t), 'words': utterance,
+                         'obv_role': ['def', 'wv', 'lj'][(t + u) % 3], 'sex': ['m', 'f'][t % 2]})
+    worddata = pd.DataFrame(rows)
+    trialdata = pd.DataFrame({'obo_trial': ['t{}'.format(t) for t in range(40)], 'year': [1800 + t % 10 for t in range(40)]})
+    return worddata, trialdata
+
+
+def test_matrix_engine_matches_corpus_engine(frames, tmp_path, monkeypatch):
+    (worddata, trialdata) = frames
+    monkeypatch.setattr(bc, 'nlp', stub_model, raising=False)
+    options = dict(repeats=12, interval=5, outfile_stem=str(tmp_path / 'words'), seed=3)
+    Areqs = [('sex', 'f')]
+    allreqs = [('obv_role', ['def', 'wv'])]
+
+    expected = bc.bootstrap_compare(Areqs, allreqs, worddata, trialdata, **options)
+    found = bc.bootstrap_compare_matrix(Areqs, allreqs, worddata, trialdata, **options)
+
+    assert expected
+    assert dict(found) == dict(expected)
+    assert sorted(score for (term, score) in found) == sorted(score for (term, score) in expected)
@@ -0,0 +1,58 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import BootstrapParallel as bp
+
+TERMS = ['theft', 'watch', 'handkerchief', 'guilty', 'constable']
+
+
+def repetition(size, rng):
+    # the indicator counts of a draw of size terms
+    counts = {}
+    for _ in range(size):
+        term = rng.choice(TERMS)
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+
+def array_repetition(size, rng):
+    return np.bincount([rng.randrange(len(TERMS)) for _ in range(size)], minlength=len(TERMS))
+
+
+def never(indicators, N):
+    return False
+
+
+def test_workers_give_the_serial_result():
+    serial = bp.run_repetitions(repetition, (7,), {}, 23, 5, never, workers=1, seed='x')
+    for workers in (2, 3):
+        assert bp.run_repetitions(repetition, (7,), {}, 23, 5, never, workers=workers, seed='x') == serial
+    (counts, N) = bp.run_repetitions(array_repetition, (7,), np.zeros(len(TERMS), dtype=np.int64), 23, 5, never,
+                                     workers=3, seed='x')
+    (expected, N1) = bp.run_repetitions(array_repetition, (7,), np.zeros(len(TERMS), dtype=np.int64), 23, 5, never,
+                                        workers=1, seed='x')
+    assert N == N1 == 23 and (counts == expected).all()
+
+
+def test_seed_reproduces_the_result():
+    first = bp.run_repetitions(repetition, (7,), {}, 10, 5, never, seed=11)
+    assert bp.run_repetitions(repetition, (7,), {}, 10, 5, never, seed=11) == first
+    assert bp.run_repetitions(repetition, (7,), {}, 10, 5, never, seed=12) != first
+    assert sum(first[0].values()) == 70 and first[1] == 10
+
+
+def test_workers_stop_at_the_serial_interval():
+    checked = {}
+
+    def check(indicators, N):
+        checked.setdefault(workers, []).append(N)
+        return N >= 10
+
+    for workers in (1, 4):
+        (counts, N) = bp.run_repetitions(repetition, (3,), {}, 40, 5, check, workers=workers, seed='stop')
+        assert N == 10 and sum(counts.values()) == 30
+        assert counts == bp.run_repetitions(repetition, (3,), {}, 10, 5, never, seed='stop')[0]
+    assert checked == {1: [5, 10], 4: [5, 10]}
@@ -0,0 +1,161 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'notebooks'))
+pytest.importorskip('matplotlib')
+import CharacterisingFunctions as cf
+
+
+class Vectors:
+    # the parts of a gensim KeyedVectors which the functions use
+    def __init__(self, vectors):
+        self.vectors_of = vectors
+
+    def __contains__(self, term):
+        return term in self.vectors_of
+
+    def __getitem__(self, terms):
+        return np.array([self.vectors_of[term] for term in terms])
+
+
+class Model:
+    def __init__(self, vectors):
+        self.wv = Vectors(vectors)
+
+
+class Corpus:
+    # the counts of an nlp_tools.corpus which find_hfw_dist reads
+    def __init__(self, allworddict):
+        self.allworddict = allworddict
+
+
+def random_model(terms, dim=8, seed=0):
+    rng = np.random.RandomState(seed)
+    return Model({term: rng.randn(dim).astype(np.float32) for term in terms})
+
+
+def test_similarity_matrix_follows_training():
+    model = random_model(['a', 'b', 'c'])
+    terms = ['a', 'b', 'c', 'oov']
+    matrix = cf.similarity_matrix(terms, model, threshold=0)
+    assert cf.similarity_matrix(terms, model, threshold=0) is matrix
+    assert not matrix[3].any()
+
+    model.wv.vectors_of['a'] = model.wv.vectors_of['b'].copy()
+    retrained = cf.similarity_matrix(terms, model, threshold=0)
+    assert retrained[0, 1] == pytest.approx(1, abs=1e-5)
+
+    model.wv.vectors_of['oov'] = model.wv.vectors_of['c'].copy()
+    assert cf.similarity_matrix(terms, model, threshold=0)[2, 3] == pytest.approx(1, abs=1e-5)
+    assert len(cf.similarity_cache[model]) == 1
+
+
+def scalar_scores(distA, distB, measure, params):
+    # the scores of improved_compute_surprises before it was vectorised, one mysurprise call per term
+    (sizeA, wordlistA) = distA
+    (sizeB, wordlistB) = distB
+    dictB = cf.makedict(wordlistB)
+    return [(term, cf.mysurprise(freq, dictB.get(term, freq + 1), sizeA, sizeB, measure, params))
+            for (term, freq) in wordlistA[:params.get('threshold', len(wordlistA))]]
+
+
+@pytest.mark.parametrize('measure,params', [('pmi', {}), ('llr', {}), ('kl', {}), ('jsd', {}),
+                                            ('likelihoodlift', {'alpha': 0.3}), ('llr', {'threshold': 4})])
+def test_keyness_matches_mysurprise(measure, params):
+    countsA = {'prisoner': 30, 'watch': 12, 'handkerchief': 9, 'pocket': 9, 'gentleman': 4, 'chaise': 2}
+    # chaise is only in A, and linen and constable are only in the reference
+    countsB = {'prisoner': 120, 'watch': 15, 'handkerchief': 40, 'pocket': 11, 'gentleman': 60, 'linen': 25,
+               'constable': 33}
+    distA = cf.find_hfw_dist([Corpus(countsA)])
+    distB = cf.find_hfw_dist([Corpus(countsB)])
+    expected = scalar_scores(distA, distB, measure, params)
+
+    result = cf.keyness(distA, distB, measure, params)
+    assert len(result) == len(expected)
+    for (term, score) in expected:
+        assert result.score(term) == pytest.approx(score, abs=1e-12)
+    assert 'linen' not in result.ids
+
+    ranked = sorted(expected, key=lambda pair: pair[1], reverse=True)
+    assert [term for (term, score) in result.top()] == [term for (term, score) in ranked]
+    top = cf.improved_compute_surprises(distA, distB, measure, params, k=3, display=False)
+    if measure == 'llr':
+        ranked = [(term, score) for (term, score) in ranked if score > cf.LLR_CUTOFF]
+    else:
+        ranked = ranked[:3]
+    assert [term for (term, score) in top] == [term for (term, score) in ranked]
+    assert [score for (term, score) in top] == pytest.approx([score for (term, score) in ranked], abs=1e-12)
+
+
+def test_freqdist_unpacks_as_a_size_and_items_pair():
+    dist = cf.FreqDist.from_counts({'watch': 3, 'coat': 5, 'hat': 3, 'shoe': 1}, size=20)
+    (size, items) = dist
+    assert size == 20 and dist[0] == 20
+    assert items == dist[1] == [('coat', 5), ('watch', 3), ('hat', 3), ('shoe', 1)]
+    assert dist[1][:2] == [('coat', 5), ('watch', 3)]
+    assert len(dist) == 4
+    assert dist.get('hat') == 3 and dist.get('gown') == 0 and 'gown' not in dist
+
+
+def test_freqdist_top_keeps_ties_in_order():
+    dist = cf.FreqDist(['d', 'a', 'c', 'b', 'e'], [2, 3, 2, 3, 2])
+    assert dist.top(3).items() == [('a', 3), ('b', 3), ('d', 2)]
+    assert dist.top(4).items() == [('a', 3), ('b', 3), ('d', 2), ('c', 2)]
+    assert dist.top(1).items() == [('a', 3)]
+    assert dist.top(0).items() == []
+    assert dist.top(3).size == dist.size == 12
+    assert dist.top().items() == dist.items()
+
+
+def test_makedict_and_find_hfw_dist_types():
+    dist = cf.find_hfw_dist([Corpus({'watch': 2, 'coat': 1}), Corpus({'watch': 1, 'hat': 4})])
+    assert isinstance(dist, cf.FreqDist)
+    (size, items) = dist
+    assert size == 8 and items == [('hat', 4), ('watch', 3), ('coat', 1)]
+    assert cf.find_hfw_dist([Corpus({'watch': 2, 'coat': 1, 'hat': 4})], k=2)[1] == [('hat', 4), ('watch', 2)]
+
+    lex = cf.makedict(dist[1])
+    assert type(lex) is dict and lex == {'hat': 4, 'watch': 3, 'coat': 1}
+    assert type(cf.makedict(dist)) is dict and cf.makedict(dist) == lex
+    assert cf.makedict([('watch', 1), ('coat', 2), ('watch', 4)]) == {'watch': 5, 'coat': 2}
+
+
+def dense_edges(wordset, model, threshold):
+    # the edges of the similarity graph from the full matrix: every non-zero similarity above the diagonal
+    matrix = cf.make_matrix(wordset, model, threshold=threshold)
+    return {(i, j): float(matrix[i, j]) for i in range(len(matrix)) for j in range(i + 1, len(matrix)) if matrix[i, j] != 0}
+
+
+def streamed_edges(edges):
+    return {(i, j): sim for (rows, cols, sims) in edges for (i, j, sim) in zip(rows.tolist(), cols.tolist(), sims.tolist())}
+
+
+def test_similarity_edges_match_the_dense_graph(tmp_path):
+    terms = ['w{}'.format(i) for i in range(23)]
+    rng = np.random.RandomState(1)
+    centres = rng.randn(3, 6)
+    model = Model({term: (centres[i % 3] + 0.7 * rng.randn(6)).astype(np.float32) for (i, term) in enumerate(terms)})
+    wordset = [(term, 1) for term in terms[:10] + ['oov', ';'] + terms[10:]]
+    model.wv.vectors_of[';'] = model.wv.vectors_of['w0']
+
+    expected = dense_edges(wordset, model, 0.3)
+    assert 20 < len(expected) < len(wordset) * (len(wordset) - 1) // 2
+    for chunksize in (1, 2, 5, 7, 1024):
+        found = streamed_edges(cf.similarity_edges(wordset, model, threshold=0.3, chunksize=chunksize))
+        assert found.keys() == expected.keys()
+        assert all(found[edge] == pytest.approx(expected[edge], abs=1e-6) for edge in expected)
+
+    labels = [cf.clean(term) for (term, score) in wordset]
+    for chunksize in (3, 1024):
+        filename = str(tmp_path / 'graph{}.csv'.format(chunksize))
+        assert cf.make_graph(wordset, model, filename, threshold=0.3, chunksize=chunksize) == len(expected)
+        with open(filename) as instream:
+            lines = instream.read().splitlines()
+        assert lines[0] == 'Source;Target;Weight;Type'
+        rows = [line.split(';') for line in lines[1:]]
+        assert sorted((source, target) for (source, target, weight, kind) in rows) == sorted(
+            (labels[i], labels[j]) for (i, j) in expected)
+        assert '_SEMICOLON' in labels and all(kind == 'Undirected' for (source, target, weight, kind) in rows)
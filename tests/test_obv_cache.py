@@ -0,0 +1,77 @@
+import os
+import sys
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import obv_cache
+
+
+def strings(values):
+    #missing values as None, so that NaN compares equal to NaN
+    return [value if isinstance(value, str) else None for value in values]
+
+
+@pytest.fixture
+def frames(tmp_path):
+    path = str(tmp_path / 'obv_words.tsv')
+    words = ['hello world', 'Ünïcödé “quotes”', '', None, 'He said "no"', 'hello world']
+    rows = [(i, 't{}'.format(i % 4), ['defendant', 'witness'][i % 2], 1700 + i % 3, words[i % len(words)])
+            for i in range(40)]
+    frame = pd.DataFrame(rows, columns=['id', 'obo_trial', 'obc_role', 'year', 'words']).set_index('id')
+    frame.to_csv(path, sep='\t')
+    obv_cache.load_tsv(path)
+    cached = obv_cache.load_tsv(path)
+    assert isinstance(cached['words'].array, obv_cache.TextArray)
+    return cached, obv_cache.read_tsv(path)
+
+
+def test_str_methods(frames):
+    (cached, plain) = frames
+    assert cached['words'].str.len().equals(plain['words'].str.len())
+    assert strings(cached['words'].str.lower()) == strings(plain['words'].str.lower())
+    assert strings(cached['words'].str.replace('o', '0')) == strings(plain['words'].str.replace('o', '0'))
+    assert list(cached['words'].str.contains('hello', na=False)) == list(plain['words'].str.contains('hello', na=False))
+    assert cached['words'].str.count('l').equals(plain['words'].str.count('l'))
+    assert ([strings(split) if isinstance(split, list) else None for split in cached['words'].str.split()] ==
+            [strings(split) if isinstance(split, list) else None for split in plain['words'].str.split()])
+
+
+def test_groupby(frames):
+    (cached, plain) = frames
+    assert cached.groupby('words').size().to_dict() == plain.groupby('words').size().to_dict()
+    lengths = cached.assign(n=cached['words'].str.len()).groupby('obo_trial')['n'].sum()
+    assert lengths.equals(plain.assign(n=plain['words'].str.len()).groupby('obo_trial')['n'].sum())
+    assert ({trial: strings(words) for (trial, words) in cached.groupby('obo_trial')['words']} ==
+            {trial: strings(words) for (trial, words) in plain.groupby('obo_trial')['words']})
+
+
+def test_merge(frames):
+    (cached, plain) = frames
+    other = pd.DataFrame({'words': ['hello world', 'He said "no"'], 'tag': ['a', 'b']})
+    merged = cached.reset_index().merge(other, on='words').sort_values('id')
+    expected = plain.reset_index().merge(other, on='words').sort_values('id')
+    assert list(merged['id']) == list(expected['id']) and list(merged['tag']) == list(expected['tag'])
+    joined = cached.merge(plain[['words']], left_index=True, right_index=True, suffixes=('', '_plain'))
+    assert strings(joined['words']) == strings(joined['words_plain'])
+
+
+def test_itertuples(frames):
+    (cached, plain) = frames
+    rows = [(row.Index, row.obo_trial, row.obc_role, row.year, row.words) for row in cached.itertuples()]
+    expected = [(row.Index, row.obo_trial, row.obc_role, row.year, row.words) for row in plain.itertuples()]
+    assert [row[:4] for row in rows] == [row[:4] for row in expected]
+    assert strings(row[4] for row in rows) == strings(row[4] for row in expected)
+    assert all(isinstance(row[4], str) or np.isnan(row[4]) for row in rows)
+
+
+def test_index_is_not_parsed_as_dates(tmp_path):
+    path = str(tmp_path / 'obv_trials.tsv')
+    pd.DataFrame({'obo_trial': ['17800112', '17800223'], 'year': [1780, 1780]}).set_index('obo_trial').to_csv(path, sep='\t')
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        for frame in (obv_cache.read_tsv(path), obv_cache.load_tsv(path), obv_cache.load_tsv(path)):
+            assert list(frame.index) == [17800112, 17800223]
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+pytest.importorskip('spacy')
+import BootstrapCorpus as bc
+
+
+def test_filtered_categorical_values_are_not_valid():
+    frame = pd.DataFrame({'obc_role': pd.Categorical(['defendant', 'witness', 'victim', 'witness']),
+                          'obo_trial': ['t1', 't1', 't2', 't3']})
+    filtered = frame[frame['obc_role'] != 'victim']
+    catalogue = bc.ValueCatalogue(filtered)
+
+    assert catalogue.exists('obc_role', 'witness')
+    assert not catalogue.exists('obc_role', 'victim')
+    assert catalogue.count('obc_role', 'victim') == 0
+    assert bc.validated([('obc_role', 'victim')], catalogue) == {}
+    assert bc.validated([('obc_role', ['victim', 'witness'])], catalogue) == {'obc_role': ['witness']}